@@ -1,60 +1,223 @@
 import networkx as nx
+import numpy as np
 import random
 
-from itertools import combinations
 import osmnx as ox
+from scipy.spatial import cKDTree, Delaunay
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from shapely.geometry import Point
 
+import math
 import signal
-
-stop_flag = False
-
-def handle_interrupt(signum, frame):
-    global stop_flag
-    print('\nFinishing iteration')
-    stop_flag = True
-
-# Register the custom handler for Ctrl+C
-signal.signal(signal.SIGINT, handle_interrupt)
-
+import time
+
+
+# Stop the runs using cancel (e.g. a threading.Event) on Ctrl+C, finishing the
+# current iteration. A second Ctrl+C interrupts straight away
+def cancel_on_interrupt(cancel):
+    def handle_interrupt(signum, frame):
+        print('\nFinishing iteration')
+        cancel.set()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGINT, handle_interrupt)
+
+# Worker processes get the terminal's Ctrl+C too, they ignore it and leave
+# the parent to stop them through cancel
+def ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Reason to stop a run before its next step, or None to keep going.
+# cancel is any object with is_set() (threading or multiprocessing Event),
+# deadline is a time.time() timestamp
+def stop_reason(cancel=None, deadline=None):
+    if cancel is not None and cancel.is_set():
+        return 'cancelled'
+    if deadline is not None and time.time() >= deadline:
+        return 'time limit reached'
+    return None
+
+# Reason to stop a run whose search has stagnated: no improvement in the best
+# distance for patience iterations, or normalised pheromone entropy below min_entropy
+def stagnation_reason(iterations_without_improvement, entropy=None, patience=None, min_entropy=None):
+    if patience is not None and iterations_without_improvement >= patience:
+        return 'no improvement for ' + str(iterations_without_improvement) + ' iterations'
+    if min_entropy is not None and entropy is not None and entropy < min_entropy:
+        return 'pheromone entropy below ' + str(min_entropy)
+    return None
+
+# Add run counters (iterations, ants, ant steps, failed ants, restarts, origin
+# distance seconds) to a stats dict
+def count(stats, **amounts):
+    if stats is not None:
+        for key, amount in amounts.items():
+            stats[key] = stats.get(key, 0) + amount
+
+# Pheromone update strategies, see deposit_amounts
+STRATEGIES = ('as', 'elitist', 'rank', 'mmas')
+
+# Pheromone deposited by each ant of an iteration and by the best-so-far path:
+# 'as' every ant that reached the destination deposits Q / distance
+# 'elitist' as 'as', plus elite_weight * Q / best on the best-so-far path
+# 'rank' the ranks - 1 shortest ants deposit (ranks - r) * Q / distance for
+#   rank r, plus ranks * Q / best on the best-so-far path
+# 'mmas' only the iteration-best ant deposits, or the best-so-far path every
+#   best_every iterations, with trails kept within mmas_limits
+def deposit_amounts(strategy, distances, best_distance, iteration, Q=1.0, ranks=6, elite_weight=6, best_every=5):
+    distances = np.asarray(distances, dtype=float)
+    reached = np.isfinite(distances) & (distances > 0)
+    amounts = np.zeros(distances.size)
+    best_amount = 0.0
+
+    if strategy in ('as', 'elitist'):
+        amounts[reached] = Q / distances[reached]
+        if strategy == 'elitist':
+            best_amount = elite_weight * Q / best_distance
+    elif strategy == 'rank':
+        ranked = np.flatnonzero(reached)[np.argsort(distances[reached], kind='stable')][:ranks - 1]
+        amounts[ranked] = (ranks - 1 - np.arange(ranked.size)) * Q / distances[ranked]
+        best_amount = ranks * Q / best_distance
+    elif strategy == 'mmas':
+        if iteration % best_every == 0:
+            best_amount = Q / best_distance
+        elif reached.any():
+            iteration_best = np.flatnonzero(reached)[np.argmin(distances[reached])]
+            amounts[iteration_best] = Q / distances[iteration_best]
+    else:
+        raise ValueError('Unknown pheromone strategy: ' + str(strategy))
+
+    if not (math.isfinite(best_distance) and best_distance > 0):
+        best_amount = 0.0
+
+    return amounts, best_amount
+
+# Whether there is a best distance to derive the MMAS trail limits from. A
+# route from a node to itself has a best distance of 0 and runs without limits
+def has_mmas_limits(best_distance):
+    return math.isfinite(best_distance) and best_distance > 0
+
+# MMAS trail limits, from the best distance found so far
+def mmas_limits(best_distance, evaporation_rate, num_nodes, Q=1.0):
+    high = Q / (evaporation_rate * best_distance)
+    return high / (2 * max(num_nodes, 1)), high
+
+def check_strategy(strategy):
+    if strategy not in STRATEGIES:
+        raise ValueError('Unknown pheromone strategy: ' + str(strategy) + ', use one of ' + ', '.join(STRATEGIES))
+
+# The run stops early and returns the best solution so far when cancel is
+# set, the deadline passes or the search stagnates (see stagnation_reason).
+# Counters for the run are added to stats if given.
+# strategy selects the pheromone update (see deposit_amounts). The trails are
+# reinitialised when the search stagnates for restart_after iterations, or
+# the pheromone entropy falls below restart_entropy, keeping the best path.
+# Ants that make more than max_steps moves are dropped (see ant_move), and
+# choose from each node's candidates nearest neighbours first if given
 def ant_colony_optimisation(
-    graph, source, destination, num_ants, iterations, evaporation_rate, alpha=1, beta=5
+    graph, source, destination, num_ants, iterations, evaporation_rate, alpha=1, beta=5, distance_to_origin=None,
+    callback=None, cancel=None, deadline=None, patience=None, min_entropy=None, stats=None,
+    strategy='as', ranks=6, elite_weight=6, restart_after=None, restart_entropy=None, max_steps=None,
+    candidates=None
 ):
-    # Initialise pheromone levels
-    pheromone_levels = {edge: 1.0 for edge in graph.edges()}
+    check_strategy(strategy)
+    candidate_lists = None if candidates is None else get_candidate_lists(graph, candidates)
+
+    # Source-specific heuristic, kept off the graph so routes can share it
+    if distance_to_origin is None:
+        start = time.perf_counter()
+        distance_to_origin = origin_distances(graph, source)
+        count(stats, origin_distance_seconds=time.perf_counter() - start)
+
+    # Initialise pheromone levels (every edge starts at 1.0)
+    pheromone_levels = PheromoneStore()
+    limits = None
 
     # Best solution tracking
     best_solution = None
     best_distance = float("inf")
+    last_improvement = 0
+    last_restart = 0
 
+    reason = None
     i = 0
-    global stop_flag
     for _ in range(iterations):
-        # Allow early finish
-        if stop_flag:
-            break
-
         ant_paths = []
         # print("Iteration " + str(i))
         i += 1
         j = 1
         for ant in range(num_ants): 
+            # Allow early finish
+            reason = stop_reason(cancel, deadline)
+            if reason:
+                break
+
             print('Iteration ' + str(i) + ', ant ' + str(j) + '  ', end='\r')
             j += 1
             # Ant movement
-            ant_path = ant_move(
-                graph, source, destination, pheromone_levels, alpha, beta
+            ant_path, steps = ant_move(
+                graph, source, destination, pheromone_levels, alpha, beta, distance_to_origin, max_steps,
+                candidate_lists
             )
-            ant_paths.append((ant_path, calculate_path_distance(graph, ant_path)))
+            count(stats, ants=1, ant_steps=steps)
 
-        # Pheromone update
-        update_pheromone(graph, pheromone_levels, ant_paths, evaporation_rate)
+            # Failed ants are dropped, so they neither deposit nor count as solutions
+            if ant_path is None:
+                count(stats, failed_ants=1)
+                continue
+            ant_paths.append((ant_path, calculate_path_distance(graph, ant_path)))
 
         # Update best solution
         for path, distance in ant_paths:
             if distance < best_distance:
                 best_solution = path
                 best_distance = distance
+                last_improvement = i
+
+        if reason:
+            break
+
+        # Pheromone update
+        amounts, best_amount = deposit_amounts(
+            strategy, [distance for _, distance in ant_paths], best_distance, i, ranks=ranks, elite_weight=elite_weight
+        )
+        deposits = [(path, amount) for (path, _), amount in zip(ant_paths, amounts) if amount > 0]
+        if best_amount > 0:
+            deposits.append((best_solution, best_amount))
+        update_pheromone(graph, pheromone_levels, deposits, evaporation_rate)
+        count(stats, iterations=1)
+
+        if strategy == 'mmas' and best_solution is not None and has_mmas_limits(best_distance):
+            # Trails start at the upper limit once there is a best distance to derive it from
+            if limits is None:
+                pheromone_levels.reset(mmas_limits(best_distance, evaporation_rate, graph.number_of_nodes())[1])
+            limits = mmas_limits(best_distance, evaporation_rate, graph.number_of_nodes())
+            pheromone_levels.clamp(*limits)
+
+        # Report progress, the callback can return False to stop the run
+        if callback is not None:
+            best_path = [graph.nodes[node]['pos'][:2] for node in best_solution] if best_solution else []
+            if callback(i, best_path, best_distance) is False:
+                reason = 'stopped by callback'
+                break
+
+        track_entropy = min_entropy is not None or restart_entropy is not None
+        entropy = pheromone_levels.entropy(graph.number_of_edges()) if track_entropy else None
+        reason = stagnation_reason(i - last_improvement, entropy, patience, min_entropy)
+        if reason:
+            break
+
+        # Reinitialise the trails on stagnation
+        if stagnation_reason(i - max(last_improvement, last_restart), entropy, restart_after, restart_entropy):
+            pheromone_levels.reset(1.0 if limits is None else limits[1])
+            last_restart = i
+            count(stats, restarts=1)
+
+    if reason:
+        print('\nStopped after ' + str(i) + ' iterations: ' + reason)
+
+    if best_solution is None:
+        return [], best_distance
 
     # Convert node labels to Shapely Point objects
     best_path_points = [Point(graph.nodes[node]['pos']) for node in best_solution]
@@ -65,18 +228,40 @@ def ant_colony_optimisation(
     return best_path_points, best_distance
 
 
-# Ant movement
-def ant_move(graph, source, destination, pheromone_levels, alpha, beta):
+# Ant movement. The ant never revisits a node: at a dead end (every neighbour
+# visited) it steps back along its path, so the path it returns is its walk
+# with the loops erased. Returns the path, or None if the ant backtracks past
+# the source or makes more than max_steps moves, and the number of moves made.
+# candidate_lists are from get_candidate_lists
+def ant_move(
+    graph, source, destination, pheromone_levels, alpha, beta, distance_to_origin=None, max_steps=None,
+    candidate_lists=None
+):
     current_node = source
     path = [current_node]
-    visited_nodes = set()
+    visited_nodes = {current_node}
+    steps = 0
 
     while current_node != destination:
+        if max_steps is not None and steps >= max_steps:
+            return None, steps
+        steps += 1
+
         # Calculate probabilities for selecting the next node
         probabilities = calculate_probabilities(
-            graph, current_node, destination, pheromone_levels, alpha, beta, visited_nodes
+            graph, current_node, destination, pheromone_levels, alpha, beta, visited_nodes,
+            distance_to_origin=distance_to_origin,
+            candidates=None if candidate_lists is None else candidate_lists[current_node]
         )
 
+        # Dead end: step back to the previous node
+        if all(probability == 0 for _, probability in probabilities):
+            path.pop()
+            if not path:
+                return None, steps
+            current_node = path[-1]
+            continue
+
         # Choose the next node based on probabilities
         next_node = choose_next_node(graph, current_node, probabilities)
 
@@ -85,31 +270,36 @@ def ant_move(graph, source, destination, pheromone_levels, alpha, beta):
         path.append(current_node)
         visited_nodes.add(current_node)
 
-    return path
+    return path, steps
 
-def calculate_probabilities(graph, current_node, destination, pheromone_levels, alpha, beta, visited_nodes, gamma=1, delta=0.2):
-    neighbors = list(graph.neighbors(current_node))
+def calculate_probabilities(graph, current_node, destination, pheromone_levels, alpha, beta, visited_nodes, gamma=1, delta=0.2, distance_to_origin=None, candidates=None):
+    # Choose from the node's candidate list first, and from every neighbour
+    # once all the candidates have been visited
+    neighbors = [] if candidates is None else candidates
     unvisited_neighbors = [neighbor for neighbor in neighbors if neighbor not in visited_nodes]
+    if not unvisited_neighbors:
+        neighbors = list(graph.neighbors(current_node))
+        unvisited_neighbors = [neighbor for neighbor in neighbors if neighbor not in visited_nodes]
     probabilities = []
 
     # If there are unvisited neighbors, calculate probabilities for them
     if unvisited_neighbors:
         # Calculate probabilities for each unvisited neighbor
         for neighbor in unvisited_neighbors:
-            pheromone = pheromone_levels.get(
-                (current_node, neighbor),
-                pheromone_levels.get((neighbor, current_node), 1.0),
-            )
+            pheromone = pheromone_levels.get(current_node, neighbor)
 
             distance_to_neighbour = graph[current_node][neighbor].get("weight", 1.0)
 
             population = graph.nodes[neighbor].get("sum_population", 60)
-            normalised_pop = (population - 6) / (150 - 6)
+            normalised_pop = max((population - 6) / (150 - 6), 0)
 
-            distance_to_origin = graph.nodes[current_node]['distance_to_origin']
+            if distance_to_origin is None:
+                origin_distance = graph.nodes[current_node]['distance_to_origin']
+            else:
+                origin_distance = distance_to_origin[current_node]
 
             # Calculate the probability using the formula for ant movement
-            probability = (pheromone**alpha) * ((1 / distance_to_neighbour) ** beta) * (normalised_pop ** gamma) * ((1 / distance_to_origin) ** delta)
+            probability = (pheromone**alpha) * ((1 / distance_to_neighbour) ** beta) * (normalised_pop ** gamma) * ((1 / origin_distance) ** delta)
             probabilities.append((neighbor, probability))
 
         # Normalize probabilities
@@ -168,58 +358,226 @@ def calculate_path_distance(graph, path):
     return total_distance
 
 
-def update_pheromone(graph, pheromone_levels, ant_paths, evaporation_rate, Q=1.0):
-    # Evaporation: Update pheromone levels on all edges
-    for edge in graph.edges():
-        pheromone_levels[edge] *= 1 - evaporation_rate
+# deposits are (path, amount) pairs from deposit_amounts
+def update_pheromone(graph, pheromone_levels, deposits, evaporation_rate):
+    # Evaporation: applied to all edges at once through the store's decay scale
+    pheromone_levels.evaporate(evaporation_rate)
 
-    # Deposit pheromone on the edges of the best path found by each ant
-    for ant_path, path_distance in ant_paths:
-        pheromone_deposit = (
-            Q / path_distance
-        )  # Q is a constant representing the pheromone deposit
+    # Deposit pheromone on the edges of each depositing path
+    for ant_path, pheromone_deposit in deposits:
         for i in range(len(ant_path) - 1):
-            try:
-                edge = (
-                    min(ant_path[i], ant_path[i + 1]),
-                    max(ant_path[i], ant_path[i + 1]),
-                )
-                pheromone_levels[edge] += pheromone_deposit
-            except KeyError:
-                edge = (
-                    max(ant_path[i], ant_path[i + 1]),
-                    min(ant_path[i], ant_path[i + 1]),
-                )
-                pheromone_levels[edge]
-
-def create_graph_with_distances(bus_stops):
-    G = nx.Graph()
-
-    for index, row in bus_stops.iterrows():
-        G.add_node(row['ref'], pos=(row['geometry'].x, row['geometry'].y, row['sum_population']))
-
-    nan_nodes = []
-    for node in G.nodes():
-        try:
-            int(node)
-        except ValueError:
-            nan_nodes.append(node)
-    G.remove_nodes_from(nan_nodes)
-
-    # Add edges with distances and calculate the distance from the origin to each node
-    for (node1, data1), (node2, data2) in combinations(G.nodes(data=True), 2):
-        distance = ((data1['pos'][0] - data2['pos'][0]) ** 2 + (data1['pos'][1] - data2['pos'][1]) ** 2) ** 0.5
-        G.add_edge(node1, node2, weight=distance)
+            pheromone_levels.deposit(ant_path[i], ant_path[i + 1], pheromone_deposit)
+
+
+# Each node's k nearest neighbours by edge weight
+def candidate_lists(graph, k):
+    return {
+        node: sorted(graph[node], key=lambda neighbor: graph[node][neighbor].get('weight', 1.0))[:k]
+        for node in graph.nodes()
+    }
+
+# Candidate lists stored on the graph, so routes sharing the graph compute them once
+def get_candidate_lists(graph, k):
+    cached = graph.graph.get('candidate_lists')
+    if cached is None or cached[0] != k or len(cached[1]) != graph.number_of_nodes():
+        cached = (k, candidate_lists(graph, k))
+        graph.graph['candidate_lists'] = cached
+
+    return cached[1]
+
+
+# Undirected edges are stored under one orientation
+def edge_key(u, v):
+    return (u, v) if u <= v else (v, u)
+
+
+# Pheromone levels with lazy evaporation. Stored values are scaled by a global
+# decay factor, so evaporating costs O(1) and each iteration only touches the
+# edges the ants deposited on. Edges never deposited on keep the initial level
+class PheromoneStore:
+    def __init__(self, initial=1.0, min_scale=1e-100):
+        self.levels = {}
+        self.initial = initial
+        self.scale = 1.0
+        self.min_scale = min_scale
+
+    def get(self, u, v):
+        return self.levels.get(edge_key(u, v), self.initial) * self.scale
+
+    def evaporate(self, evaporation_rate):
+        self.scale *= 1 - evaporation_rate
+
+        # Fold the scale back into the stored values before it underflows
+        if self.scale <= self.min_scale:
+            self.renormalise()
+
+    def deposit(self, u, v, amount):
+        key = edge_key(u, v)
+        self.levels[key] = self.levels.get(key, self.initial) + amount / self.scale
+
+    # Shannon entropy of the pheromone distribution over num_edges edges,
+    # normalised to [0, 1]; low values mean the trails have converged
+    def entropy(self, num_edges):
+        untouched = num_edges - len(self.levels)
+        total = sum(self.levels.values()) + self.initial * untouched
+        if num_edges < 2 or total <= 0:
+            return 0.0
+
+        entropy = -sum(level / total * math.log(level / total) for level in self.levels.values() if level > 0)
+        if self.initial > 0 and untouched > 0:
+            entropy -= untouched * (self.initial / total) * math.log(self.initial / total)
+
+        return entropy / math.log(num_edges)
+
+    def renormalise(self):
+        for key in self.levels:
+            self.levels[key] *= self.scale
+        self.initial *= self.scale
+        self.scale = 1.0
+
+    # Set every edge back to level
+    def reset(self, level):
+        self.levels.clear()
+        self.initial = level
+        self.scale = 1.0
+
+    # Keep every edge within [low, high], only touching edges deposited on
+    def clamp(self, low, high):
+        self.renormalise()
+        for key, level in self.levels.items():
+            self.levels[key] = min(max(level, low), high)
+        self.initial = min(max(self.initial, low), high)
+
+# Build the bus stop graph. The default is a sparse neighbourhood graph:
+# 'knn' joins each stop to its k nearest stops, 'radius' to every stop within
+# radius, 'delaunay'/'gabriel' use the (Gabriel subset of the) Delaunay
+# triangulation. 'complete' joins every pair and is only suited to small inputs
+def create_graph_with_distances(bus_stops, mode='knn', k=8, radius=None):
+    # Remove stops without a numeric ref, later rows win for duplicated refs
+    has_ref = bus_stops['ref'].map(is_int_like).astype(bool)
+    stops = bus_stops[has_ref].drop_duplicates(subset='ref', keep='last')
+
+    nodes = stops['ref'].tolist()
+    coords = np.column_stack([stops.geometry.x.to_numpy(dtype=float), stops.geometry.y.to_numpy(dtype=float)])
+    population = stops['sum_population'].to_numpy(dtype=float)
+
+    # Add edges with distances, joining components so every pair of stops is connected
+    pairs = neighbour_pairs(coords, mode, k, radius)
+    pairs = connect_components(coords, pairs)
+    distances = np.hypot(*(coords[pairs[:, 0]] - coords[pairs[:, 1]]).T)
+
+    # Positions and populations are also kept as arrays on the graph itself.
+    # The engines read sum_population, stops outside every meshblock go
+    # without and get the default
+    G = nx.Graph(pos=coords, population=population)
+    G.add_nodes_from(
+        (node, {'pos': (x, y, pop)} if np.isnan(pop) else {'pos': (x, y, pop), 'sum_population': pop})
+        for node, (x, y), pop in zip(nodes, coords.tolist(), population.tolist())
+    )
+    G.add_weighted_edges_from(
+        (nodes[a], nodes[b], distance) for (a, b), distance in zip(pairs.tolist(), distances.tolist())
+    )
 
     return G
 
-def calc_origin_dist(G, origin):
-    # Calculate the distance from the origin to each node
-    for node in G.nodes():
-        distance_to_origin = ((G.nodes[node]['pos'][0] - G.nodes[origin]['pos'][0]) ** 2 + (G.nodes[node]['pos'][1] - G.nodes[origin]['pos'][1]) ** 2) ** 0.5
-        G.nodes[node]['distance_to_origin'] = distance_to_origin
+def is_int_like(value):
+    try:
+        int(value)
+    except (ValueError, TypeError):
+        return False
+    return True
+
+# Index pairs (i < j) of the stops to join for the given mode
+def neighbour_pairs(coords, mode='knn', k=8, radius=None):
+    n = len(coords)
+    if n < 2:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # Triangulation needs at least a few points
+    if mode in ('delaunay', 'gabriel') and n < 4:
+        mode = 'complete'
+
+    if mode == 'complete':
+        pairs = np.column_stack(np.triu_indices(n, 1))
+    elif mode == 'knn':
+        k = min(k, n - 1)
+        _, neighbours = cKDTree(coords).query(coords, k=k + 1)
+        pairs = np.column_stack([np.repeat(np.arange(n), k), neighbours[:, 1:].ravel()])
+    elif mode == 'radius':
+        if radius is None:
+            raise ValueError("radius mode needs a radius")
+        pairs = cKDTree(coords).query_pairs(radius, output_type='ndarray')
+    elif mode in ('delaunay', 'gabriel'):
+        simplices = Delaunay(coords).simplices
+        pairs = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+    else:
+        raise ValueError("Unknown graph mode: " + str(mode))
+
+    # Orient as (i < j) and remove duplicates
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+
+    if mode == 'gabriel':
+        # Keep an edge only if no other stop lies inside the circle on its diameter
+        midpoints = (coords[pairs[:, 0]] + coords[pairs[:, 1]]) / 2
+        half_lengths = np.hypot(*(coords[pairs[:, 0]] - coords[pairs[:, 1]]).T) / 2
+        nearest, _ = cKDTree(coords).query(midpoints, k=1)
+        pairs = pairs[nearest >= half_lengths * (1 - 1e-9)]
+
+    return pairs
+
+# Add the shortest links between components until the graph is connected
+def connect_components(coords, pairs):
+    n = len(coords)
+    if n < 2:
+        return pairs
+
+    tree = cKDTree(coords)
+    while True:
+        adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+        count, labels = connected_components(adjacency, directed=False)
+        if count == 1:
+            return pairs
+
+        # Every component except the largest links to its nearest outside stop,
+        # so the number of components at least halves each round
+        largest = np.argmax(np.bincount(labels))
+        links = []
+        for component in range(count):
+            if component == largest:
+                continue
+
+            members = np.flatnonzero(labels == component)
+            distances, neighbours = tree.query(coords[members], k=min(16, n))
+            outside = labels[neighbours] != component
+            if outside.any():
+                distances = np.where(outside, distances, np.inf)
+                member, column = np.unravel_index(np.argmin(distances), distances.shape)
+                links.append((members[member], neighbours[member, column]))
+            else:
+                others = np.flatnonzero(labels != component)
+                distances, neighbours = cKDTree(coords[others]).query(coords[members], k=1)
+                member = np.argmin(distances)
+                links.append((members[member], others[neighbours[member]]))
+
+        links = np.sort(np.array(links, dtype=pairs.dtype), axis=1)
+        pairs = np.unique(np.concatenate([pairs, links]), axis=0)
+
+# Calculate the distance from the origin to each node, without changing the graph
+def origin_distances(G, origin):
+    origin_pos = G.nodes[origin]['pos']
+
+    distance_to_origin = {}
+    for node, pos in G.nodes(data='pos'):
+        distance_to_origin[node] = ((pos[0] - origin_pos[0]) ** 2 + (pos[1] - origin_pos[1]) ** 2) ** 0.5
+
+    distance_to_origin[origin] = 1
+
+    return distance_to_origin
 
-    G.nodes[origin]['distance_to_origin'] = 1
+def calc_origin_dist(G, origin):
+    # Store the distance from the origin on each node
+    nx.set_node_attributes(G, origin_distances(G, origin), 'distance_to_origin')
 
     return G
 
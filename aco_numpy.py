@@ -0,0 +1,529 @@
+import hashlib
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from shapely.geometry import Point
+
+import aco
+
+
+# Graph stored as CSR arrays indexed by integer node id, so the ants can be
+# advanced as a batch without touching networkx dicts in the inner loop.
+# nodes maps each id back to the original node label (e.g. the OSM id).
+# Each node's neighbours are sorted by edge weight, so its first k entries
+# are its k nearest neighbours (the candidate list). The arrays may be
+# read-only memory maps of a published snapshot (see snapshots.py)
+class GraphArrays:
+    def __init__(self, nodes, indptr, indices, weights, edge_ids, population, coords):
+        self.nodes = nodes
+        self._index = None
+
+        # Data derived from the graph, like networkx's graph.graph (e.g. the
+        # node index used for snapping)
+        self.graph = {}
+
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.edge_ids = edge_ids
+
+        self.population = population
+        self.coords = coords
+        self._fingerprint = None
+
+    # Node label -> id, built on first use
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = {node: i for i, node in enumerate(self.nodes)}
+        return self._index
+
+    # Hash of the node labels, adjacency and weights, identifying the graph
+    # across processes and restarts (e.g. for stored pheromone)
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            # Labels as Python values, so lists and arrays of the same labels match
+            digest = hashlib.blake2b(repr(np.asarray(self.nodes).tolist()).encode(), digest_size=16)
+            for array in (self.indptr, self.indices, self.weights, self.edge_ids):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @property
+    def num_nodes(self):
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self):
+        # Number of undirected edges (each is stored twice in the CSR arrays)
+        return int(self.edge_ids.max()) + 1 if self.edge_ids.size else 0
+
+
+# Convert a networkx graph into CSR arrays
+def graph_to_arrays(graph, default_population=60):
+    nodes = list(graph.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    n = len(nodes)
+
+    edges = [(index[u], index[v], w) for u, v, w in graph.edges(data='weight', default=1.0) if u != v]
+    u = np.fromiter((e[0] for e in edges), dtype=np.int64, count=len(edges))
+    v = np.fromiter((e[1] for e in edges), dtype=np.int64, count=len(edges))
+    w = np.fromiter((e[2] for e in edges), dtype=np.float64, count=len(edges))
+
+    # Store both directions of each undirected edge, sharing one edge id
+    edge_range = np.arange(len(edges))
+    src = np.concatenate([u, v])
+    dst = np.concatenate([v, u])
+    order = np.lexsort((dst, np.concatenate([w, w]), src))
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    indices = dst[order]
+    weights = np.concatenate([w, w])[order]
+    edge_ids = np.concatenate([edge_range, edge_range])[order]
+
+    population = np.array(
+        [graph.nodes[node].get('sum_population', default_population) for node in nodes], dtype=np.float64
+    )
+    population[np.isnan(population)] = default_population
+
+    coords = np.array([graph.nodes[node]['pos'][:2] for node in nodes], dtype=np.float64).reshape(n, 2)
+
+    return GraphArrays(nodes, indptr, indices, weights, edge_ids, population, coords)
+
+
+# Compact an osmnx road graph (MultiDiGraph) straight into CSR arrays, without
+# building an nx.Graph. Edges in either direction and parallel edges between
+# two intersections become one undirected edge with the shortest length.
+# Ids are int32 and lengths float32, coordinates come from the OSM x/y and
+# population from process_data_intersections
+def road_graph_to_arrays(roads, weight='length', default_population=60):
+    nodes = np.array(list(roads.nodes()))
+    index = {node: i for i, node in enumerate(nodes.tolist())}
+    n = len(nodes)
+
+    edges = roads.edges(data=weight, default=1.0)
+    u = np.fromiter((index[a] for a, _, _ in edges), dtype=np.int64, count=len(edges))
+    v = np.fromiter((index[b] for _, b, _ in edges), dtype=np.int64, count=len(edges))
+    w = np.fromiter((length for _, _, length in edges), dtype=np.float64, count=len(edges))
+
+    # Drop self-loops and keep the shortest edge between each pair of nodes
+    keep = u != v
+    low, high, w = np.minimum(u, v)[keep], np.maximum(u, v)[keep], w[keep]
+    order = np.lexsort((w, high, low))
+    low, high, w = low[order], high[order], w[order]
+    first = np.ones(low.size, dtype=bool)
+    first[1:] = (low[1:] != low[:-1]) | (high[1:] != high[:-1])
+    low, high, w = low[first], high[first], w[first]
+
+    # Store both directions of each undirected edge, sharing one edge id
+    edge_range = np.arange(low.size, dtype=np.int32)
+    src = np.concatenate([low, high])
+    dst = np.concatenate([high, low])
+    order = np.lexsort((dst, np.concatenate([w, w]), src))
+
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    indices = dst[order].astype(np.int32)
+    weights = np.concatenate([w, w])[order].astype(np.float32)
+    edge_ids = np.concatenate([edge_range, edge_range])[order]
+
+    population = np.fromiter(
+        (p for _, p in roads.nodes(data='sum_population', default=default_population)), dtype=np.float32, count=n
+    )
+    population[np.isnan(population)] = default_population
+
+    coords = np.empty((n, 2))
+    coords[:, 0] = np.fromiter((x for _, x in roads.nodes(data='x')), dtype=np.float64, count=n)
+    coords[:, 1] = np.fromiter((y for _, y in roads.nodes(data='y')), dtype=np.float64, count=n)
+
+    return GraphArrays(nodes, indptr, indices, weights, edge_ids, population, coords)
+
+
+# Distance from the origin to each node, matching aco.calc_origin_dist
+def origin_distances(arrays, source):
+    distance_to_origin = np.hypot(*(arrays.coords - arrays.coords[source]).T)
+    distance_to_origin[distance_to_origin == 0] = 1
+
+    return distance_to_origin
+
+
+# Stops early, counts stats, updates the pheromone (strategy, ranks,
+# elite_weight, restart_after, restart_entropy), bounds the walks (max_steps)
+# and uses candidate lists (candidates) like aco.ant_colony_optimisation.
+# pheromone gives the starting level of each edge (see pheromone_cache), and
+# holds the final levels when the run returns
+def ant_colony_optimisation(
+    graph, source, destination, num_ants, iterations, evaporation_rate, alpha=1, beta=5, gamma=1, delta=0.2, Q=1.0,
+    seed=None, workers=1, callback=None, cancel=None, deadline=None, patience=None, min_entropy=None, stats=None,
+    strategy='as', ranks=6, elite_weight=6, restart_after=None, restart_entropy=None, max_steps=None,
+    candidates=None, pheromone=None
+):
+    aco.check_strategy(strategy)
+    arrays = graph if isinstance(graph, GraphArrays) else graph_to_arrays(graph)
+    rng = np.random.default_rng(seed)
+
+    source = arrays.index[source]
+    destination = arrays.index[destination]
+
+    # Initialise pheromone levels, one entry per undirected edge
+    warm_start = pheromone is not None
+    if pheromone is None:
+        pheromone = np.ones(arrays.num_edges)
+    elif pheromone.shape != (arrays.num_edges,):
+        raise ValueError('Expected ' + str(arrays.num_edges) + ' pheromone levels, got ' + str(pheromone.size))
+    levels = pheromone
+    limits = None
+
+    # Static part of the attractiveness, one entry per CSR edge
+    # (in float64, as compact graphs store float32 lengths)
+    normalised_pop = np.clip((arrays.population.astype(np.float64) - 6) / (150 - 6), 0, None)
+    heuristic = ((1 / arrays.weights.astype(np.float64)) ** beta) * (normalised_pop[arrays.indices] ** gamma)
+    start = time.perf_counter()
+    origin_factor = (1 / origin_distances(arrays, source)) ** delta
+    aco.count(stats, origin_distance_seconds=time.perf_counter() - start)
+
+    # Split the ants of each iteration across a process pool
+    if workers > 1:
+        pool = AntPool(arrays, pheromone, heuristic, origin_factor, workers, seed)
+        pheromone = pool.pheromone
+
+    # Best solution tracking
+    best_solution = None
+    best_entries = None
+    best_distance = float("inf")
+    last_improvement = 0
+    last_restart = 0
+
+    reason = None
+    completed = 0
+    try:
+        for i in range(iterations):
+            # Allow early finish
+            reason = aco.stop_reason(cancel, deadline)
+            if reason:
+                break
+
+            print('Iteration ' + str(i + 1) + '  ', end='\r')
+
+            # Ant movement
+            if workers > 1:
+                ant_ids, entries, distances, steps = pool.construct_solutions(
+                    i, source, destination, num_ants, alpha, max_steps, candidates
+                )
+            else:
+                ant_ids, entries, distances, steps = construct_solutions(
+                    arrays, pheromone, heuristic, origin_factor, source, destination, num_ants, alpha, rng, max_steps,
+                    candidates
+                )
+
+            # Update best solution
+            best_ant = int(np.argmin(distances))
+            if distances[best_ant] < best_distance:
+                best_entries = entries[ant_ids == best_ant]
+                best_solution = [source] + arrays.indices[best_entries].tolist()
+                best_distance = float(distances[best_ant])
+                last_improvement = i + 1
+
+            # Pheromone update
+            amounts, best_amount = aco.deposit_amounts(
+                strategy, distances, best_distance, i + 1, Q, ranks, elite_weight
+            )
+            update_pheromone(arrays, pheromone, ant_ids, entries, amounts, evaporation_rate, best_entries, best_amount)
+            completed = i + 1
+            aco.count(
+                stats, iterations=1, ants=num_ants, ant_steps=steps, failed_ants=int(np.isinf(distances).sum())
+            )
+
+            if strategy == 'mmas' and best_solution is not None and aco.has_mmas_limits(best_distance):
+                # Trails start at the upper limit once there is a best distance
+                # to derive it from, unless they were warm started
+                if limits is None and not warm_start:
+                    pheromone.fill(aco.mmas_limits(best_distance, evaporation_rate, arrays.num_nodes, Q)[1])
+                limits = aco.mmas_limits(best_distance, evaporation_rate, arrays.num_nodes, Q)
+                np.clip(pheromone, *limits, out=pheromone)
+
+            # Report progress, the callback can return False to stop the run
+            if callback is not None:
+                best_path = arrays.coords[best_solution].tolist() if best_solution else []
+                if callback(i + 1, best_path, best_distance) is False:
+                    reason = 'stopped by callback'
+                    break
+
+            track_entropy = min_entropy is not None or restart_entropy is not None
+            entropy = pheromone_entropy(pheromone) if track_entropy else None
+            reason = aco.stagnation_reason(i + 1 - last_improvement, entropy, patience, min_entropy)
+            if reason:
+                break
+
+            # Reinitialise the trails on stagnation
+            if aco.stagnation_reason(i + 1 - max(last_improvement, last_restart), entropy, restart_after, restart_entropy):
+                pheromone.fill(1.0 if limits is None else limits[1])
+                last_restart = i + 1
+                aco.count(stats, restarts=1)
+    finally:
+        if workers > 1:
+            levels[:] = pheromone
+            pool.close()
+
+    if reason:
+        print('\nStopped after ' + str(completed) + ' iterations: ' + reason)
+
+    if best_solution is None:
+        return [], best_distance
+
+    # Convert node ids to Shapely Point objects
+    best_path_points = [Point(arrays.coords[node]) for node in best_solution]
+
+    return best_path_points, best_distance
+
+
+# Advance all ants of an iteration together until each reaches the
+# destination, with the walk policy of aco.ant_move: ants never revisit a node
+# and step back along their path at a dead end, so each path is the ant's walk
+# with the loops erased. An ant fails if it backtracks past the source or
+# makes more than max_steps moves. With candidates, ants choose from the first
+# candidates entries of each node (its nearest neighbours), and from all of
+# them only once every candidate has been visited.
+# Returns the ant and CSR edge entry of every edge on the paths of the ants
+# that arrived, in path order, the distance of each ant's path (inf for
+# failed ants) and the total number of moves made
+def construct_solutions(
+    arrays, pheromone, heuristic, origin_factor, source, destination, num_ants, alpha, rng, max_steps=None,
+    candidates=None
+):
+    indptr, indices = arrays.indptr, arrays.indices
+    n = arrays.num_nodes
+
+    # Each ant's path so far as a stack of CSR entries, a simple path has at most n - 1 edges
+    width = max(n - 1, 1) if max_steps is None else max(min(n - 1, max_steps), 1)
+    path_entries = np.zeros((num_ants, width), dtype=indptr.dtype)
+    depth = np.zeros(num_ants, dtype=np.int64)
+
+    current = np.full(num_ants, source)
+    visited = np.zeros((num_ants, n), dtype=bool)
+    visited[:, source] = True
+    distances = np.zeros(num_ants)
+    steps = np.zeros(num_ants, dtype=np.int64)
+    failed = np.zeros(num_ants, dtype=bool)
+
+    active = np.flatnonzero(current != destination)
+    while active.size:
+        nodes = current[active]
+        start = indptr[nodes]
+        degree = indptr[nodes + 1] - start
+        count = degree if candidates is None else np.minimum(degree, candidates)
+
+        owner, segment_start, entries = flatten_segments(start, count)
+        unvisited = ~visited[active[owner], indices[entries]]
+        has_unvisited = np.bincount(owner, weights=unvisited, minlength=active.size) > 0
+
+        # Fall back to the whole neighbourhood where every candidate has been visited
+        widen = ~has_unvisited & (count < degree)
+        if widen.any():
+            count = np.where(widen, degree, count)
+            owner, segment_start, entries = flatten_segments(start, count)
+            unvisited = ~visited[active[owner], indices[entries]]
+            has_unvisited = np.bincount(owner, weights=unvisited, minlength=active.size) > 0
+
+        # Calculate probabilities for each unvisited neighbour
+        weight = (pheromone[arrays.edge_ids[entries]] ** alpha) * heuristic[entries] * origin_factor[nodes][owner]
+        weight[~unvisited] = 0
+
+        # If the total is zero, use equal probabilities for the unvisited
+        # neighbours. Ants without any (dead ends) get equal probabilities
+        # too, but step back instead of using their draw
+        totals = np.bincount(owner, weights=weight, minlength=active.size)
+        fallback = (totals <= 0)[owner]
+        weight[fallback] = np.where(has_unvisited[owner], unvisited, True)[fallback]
+        totals = np.bincount(owner, weights=weight, minlength=active.size)
+
+        # Roulette selection: each segment is normalised to sum to one, so the
+        # k-th ant's draw lies in [k, k + 1) of the cumulative sum
+        cumulative = np.cumsum(weight / np.where(totals > 0, totals, 1)[owner])
+        draws = np.arange(active.size) + rng.random(active.size)
+        chosen = np.searchsorted(cumulative, draws, side='right')
+        chosen = np.clip(chosen, segment_start, segment_start + np.maximum(count, 1) - 1)
+        steps[active] += 1
+
+        # Dead ends: step back to the previous node, failing at the source
+        dead = active[~has_unvisited]
+        if dead.size:
+            failed[dead[depth[dead] == 0]] = True
+            back = dead[depth[dead] > 0]
+            depth[back] -= 1
+            distances[back] -= arrays.weights[path_entries[back, depth[back]]]
+            previous = path_entries[back, np.maximum(depth[back] - 1, 0)]
+            current[back] = np.where(depth[back] > 0, indices[previous], source)
+
+        # Move to the next node
+        moving = active[has_unvisited]
+        chosen_entries = entries[chosen[has_unvisited]]
+        next_nodes = indices[chosen_entries]
+        path_entries[moving, depth[moving]] = chosen_entries
+        depth[moving] += 1
+        distances[moving] += arrays.weights[chosen_entries]
+        visited[moving, next_nodes] = True
+        current[moving] = next_nodes
+
+        # Ants out of moves (or path space) before reaching the destination fail
+        if max_steps is not None:
+            out_of_steps = (steps >= max_steps) | (depth >= width)
+            failed |= out_of_steps & (current != destination)
+
+        active = np.flatnonzero(~failed & (current != destination))
+
+    distances[failed] = np.inf
+
+    # Entries of every arrived ant's path, in path order
+    on_path = (np.arange(width) < depth[:, None]) & ~failed[:, None]
+    ant_ids, positions = np.nonzero(on_path)
+
+    return ant_ids, path_entries[ant_ids, positions].astype(np.int64), distances, int(steps.sum())
+
+
+# Flatten the CSR segments [start, start + count) of the active ants into one
+# array of entries, with the ant (owner) and segment start of each entry
+def flatten_segments(start, count):
+    owner = np.repeat(np.arange(count.size), count)
+    segment_start = np.cumsum(count) - count
+    entries = np.repeat(start, count) + np.arange(owner.size) - segment_start[owner]
+
+    return owner, segment_start, entries
+
+
+# Shannon entropy of the pheromone distribution, normalised to [0, 1]
+def pheromone_entropy(pheromone):
+    total = pheromone.sum()
+    if pheromone.size < 2 or total <= 0:
+        return 0.0
+
+    share = pheromone[pheromone > 0] / total
+    return float(-(share * np.log(share)).sum() / np.log(pheromone.size))
+
+
+# amounts and best_amount are the deposits from aco.deposit_amounts, per ant
+# and on the best-so-far path (the CSR entries best_entries)
+def update_pheromone(arrays, pheromone, ant_ids, entries, amounts, evaporation_rate, best_entries=None, best_amount=0.0):
+    # Evaporation
+    pheromone *= 1 - evaporation_rate
+
+    # Deposit on every edge walked by each depositing ant
+    deposit = amounts[ant_ids]
+    depositing = deposit > 0
+    np.add.at(pheromone, arrays.edge_ids[entries[depositing]], deposit[depositing])
+
+    if best_amount > 0:
+        np.add.at(pheromone, arrays.edge_ids[best_entries], best_amount)
+
+
+# Process pool that constructs the ants of an iteration in parallel. The
+# graph arrays, heuristic and pheromone live in shared memory, so workers read
+# them without pickling the graph, and the main process updates the pheromone
+# in place between iterations. Each chunk of ants draws from its own random
+# stream derived from (seed, iteration, chunk), so runs with the same seed and
+# number of workers are reproducible
+class AntPool:
+    def __init__(self, arrays, pheromone, heuristic, origin_factor, workers, seed=None):
+        self.workers = workers
+        self.entropy = np.random.SeedSequence(seed).entropy
+
+        self.memory = []
+        shared = {}
+        for name, array in [
+            ('indptr', arrays.indptr),
+            ('indices', arrays.indices),
+            ('weights', arrays.weights),
+            ('edge_ids', arrays.edge_ids),
+            ('pheromone', pheromone),
+            ('heuristic', heuristic),
+            ('origin_factor', origin_factor),
+        ]:
+            memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            view[:] = array
+
+            self.memory.append(memory)
+            shared[name] = (memory.name, array.shape, array.dtype.str)
+            if name == 'pheromone':
+                self.pheromone = view
+
+        self.executor = ProcessPoolExecutor(workers, initializer=attach_shared_arrays, initargs=(shared,))
+
+    def construct_solutions(self, iteration, source, destination, num_ants, alpha, max_steps=None, candidates=None):
+        chunks = [chunk for chunk in np.array_split(np.arange(num_ants), self.workers) if chunk.size]
+        tasks = [
+            (
+                self.entropy, iteration, chunk_id, int(chunk[0]), chunk.size, source, destination, alpha, max_steps,
+                candidates
+            )
+            for chunk_id, chunk in enumerate(chunks)
+        ]
+        results = list(self.executor.map(construct_chunk, tasks))
+
+        ant_ids = np.concatenate([result[0] for result in results])
+        entries = np.concatenate([result[1] for result in results])
+        distances = np.concatenate([result[2] for result in results])
+        steps = sum(result[3] for result in results)
+
+        return ant_ids, entries, distances, steps
+
+    def close(self):
+        self.executor.shutdown()
+        self.pheromone = None
+
+        for memory in self.memory:
+            # The caller may still hold a view of the pheromone, in which case
+            # the mapping is released when that view is garbage collected
+            try:
+                memory.close()
+            except BufferError:
+                pass
+            memory.unlink()
+
+
+# Worker process state, attached once per process by the pool initializer
+shared_memory = []
+shared_arrays = {}
+
+def attach_shared_arrays(shared):
+    aco.ignore_interrupt()
+
+    for name, (memory_name, shape, dtype) in shared.items():
+        memory = SharedMemory(name=memory_name)
+        shared_memory.append(memory)
+        shared_arrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+    num_nodes = len(shared_arrays['indptr']) - 1
+    shared_arrays['graph'] = GraphArrays(
+        range(num_nodes),
+        shared_arrays['indptr'],
+        shared_arrays['indices'],
+        shared_arrays['weights'],
+        shared_arrays['edge_ids'],
+        None,
+        None,
+    )
+
+def construct_chunk(task):
+    entropy, iteration, chunk_id, first_ant, num_ants, source, destination, alpha, max_steps, candidates = task
+    rng = np.random.default_rng([entropy, iteration, chunk_id])
+
+    ant_ids, entries, distances, steps = construct_solutions(
+        shared_arrays['graph'],
+        shared_arrays['pheromone'],
+        shared_arrays['heuristic'],
+        shared_arrays['origin_factor'],
+        source,
+        destination,
+        num_ants,
+        alpha,
+        rng,
+        max_steps,
+        candidates,
+    )
+
+    return ant_ids + first_ant, entries, distances, steps
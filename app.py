@@ -1,105 +1,431 @@
-from flask import Flask, render_template, request, jsonify
-from plot_nodes import plot_stops, plot_census_stops, plot_census_intersections, plot_area, find_node, get_node, get_coords
-from create_display import generate_map, generate_map_colour
-import aco
+from flask import Flask, render_template, request, jsonify, Response, g
+from plot_nodes import plot_stops, stop_coordinates
+from create_display import generate_map, generate_map_colour, route_geometry, stops_geojson, routes_geojson, quantise, TILES, ATTRIBUTION, ROUTE_COLOURS
+from routing import solve_routes
+from jobs import JobManager, QueueFullError
+import data_store
+import graphs
+import metrics
+import regions
+import route_cache
+import snapshots
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import LineString
-import networkx as nx
-from itertools import cycle, islice
+import json
+import math
+import os
+import time
+import uuid
 
 app = Flask(__name__)
 
+# Background optimisation jobs, at most ACO_JOB_WORKERS run at once and
+# ACO_JOB_QUEUE more can wait
+jobs = JobManager(
+    workers=int(os.environ.get('ACO_JOB_WORKERS', 2)),
+    max_queued=int(os.environ.get('ACO_JOB_QUEUE', 8)),
+)
+
+# Bus stops from the last /generate_stops, and their GeoJSON layer (built once)
+stops = None
+stop_coords = None
+stop_layer = None
+
+# Collect phase timings for the Server-Timing header, and profile the request
+# with cProfile when ACO_PROFILING=1 and ?profile=1 is given. Jobs are
+# profiled in run_route_job instead, as they run on another thread
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+    if metrics.PROFILING and request.endpoint != 'submit_job' and request.args.get('profile', 0, type=int) == 1:
+        g.profiler = metrics.start_profile()
+
+@app.after_request
+def finish_request_metrics(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile'] = metrics.save_profile(profiler, profile_name(request.endpoint))
+
+    timings = metrics.finish_request()
+    if timings:
+        response.headers['Server-Timing'] = metrics.server_timing(timings)
+
+    return response
+
+# Phase timing histograms and ACO counters in the Prometheus text format
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.exposition(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', tiles=TILES, attribution=ATTRIBUTION, colours=ROUTE_COLOURS)
 
 @app.route('/generate_stops')
 def generate_stops():
-    global stops
-    stops = plot_stops()
-    
+    # Download the layers again instead of using the local data store
+    refresh = request.args.get('refresh', 0, type=int) == 1
+
+    load_stops(refresh)
+
     # Create leaflet
-    colours = (['#ABABAB'] * len(stops.index))
-    figure = generate_map_colour(stops, colours)
+    with metrics.timer('render'):
+        colours = (['#ABABAB'] * len(stops.index))
+        figure = generate_map_colour(stops, colours)
 
-    map_html = figure.get_root()._repr_html_()
+        map_html = figure.get_root()._repr_html_()
     return map_html
 
+# Bus stop layer as GeoJSON for the Leaflet map. It only changes when the
+# stops are reloaded, so clients revalidate it with its ETag
+@app.route('/stops.geojson')
+def stops_layer():
+    global stop_layer
+
+    refresh = request.args.get('refresh', 0, type=int) == 1
+    if stops is None or refresh:
+        load_stops(refresh)
+
+    if stop_layer is None:
+        with metrics.timer('render'):
+            stop_layer = stops_geojson(stops)
+
+    response = Response(stop_layer, mimetype='application/geo+json')
+    response.add_etag()
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def load_stops(refresh=False):
+    global stops, stop_coords, stop_layer
+    stops = plot_stops(refresh)
+    stop_coords = stop_coordinates(stops)
+    stop_layer = None
+
 @app.route('/generate_routes')
 def generate_routes():
-    start_nodes = request.args.getlist('start_node')
-    end_nodes = request.args.getlist('end_node')
+    settings = route_settings(request.args)
+
+    # Solve the routes concurrently, results are in input order
+    results = solve_cached_routes(settings)
+
+    # Only the route lines, for overlaying on the stop layer
+    if settings['format'] == 'geojson':
+        return Response(routes_geojson(results, settings['precision']), mimetype='application/geo+json')
+
+    return render_routes(results)
+
+# Submit the same request as /generate_routes as a background job
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    settings = route_settings(request.values)
+
+    try:
+        job = jobs.submit(run_route_job, settings)
+    except QueueFullError as error:
+        return jsonify({'error': str(error)}), 503
+
+    return jsonify(job.summary()), 202, {'Location': '/jobs/' + job.id}
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    return jsonify(job.summary())
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    return jsonify(job.summary())
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.result is None:
+        return jsonify(job.summary()), 409
+
+    if request.args.get('format') == 'geojson':
+        precision = request.args.get('precision', 6, type=int)
+        return Response(routes_geojson(job.result, precision), mimetype='application/geo+json')
+
+    return jsonify({'id': job.id, 'status': job.status, 'routes': [route_json(result) for result in job.result]})
+
+@app.route('/jobs/<job_id>/map')
+def job_map(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.result is None:
+        return jsonify(job.summary()), 409
+
+    return render_routes(job.result)
+
+# Server-Sent Events with the job's status changes and the best-so-far
+# distance and path of each route after every iteration
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    # Reconnecting clients resume after the last event they received
+    last_id = request.headers.get('Last-Event-ID', 0, type=int)
+
+    def stream(last_id):
+        while True:
+            events = job.events_after(last_id, timeout=15)
+            if not events:
+                if job.done():
+                    return
+                yield ': keep-alive\n\n'
+                continue
+
+            for event_id, event_type, data in events:
+                yield 'id: ' + str(event_id) + '\nevent: ' + event_type + '\ndata: ' + json.dumps(data) + '\n\n'
+                last_id = event_id
+
+    return Response(stream(last_id), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Read the route request settings from the query string or form
+def route_settings(args):
+    settings = dict(
+        start_nodes=args.getlist('start_node'),
+        end_nodes=args.getlist('end_node'),
 
-    num_ants = request.args.get('num_ants', type=int)
-    iterations = request.args.get('num_iterations', type=int)
-    evaporation_rate = 0.2
+        mode=args.get('mode'),
 
-    mode = request.args.get('mode')
+        # Download the layers again instead of using the local data store
+        refresh=args.get('refresh', 0, type=int) == 1,
 
-    global stops
+        # Bus stop graph: 'knn', 'radius', 'delaunay', 'gabriel' or 'complete'
+        graph_mode=args.get('graph', 'knn'),
+        neighbours=args.get('neighbours', 8, type=int),
+        radius=args.get('radius', type=float),
 
-    # Initialize an array to store the best paths
-    best_paths = []
+        # Weight the heuristic by commuter demand from the census travel to
+        # work data: 'demand' instead of the population, 'both' alongside it
+        demand=args.get('demand'),
 
+        # Contract the road graph (intersections mode), merging intersections
+        # within this many metres and chains of degree-2 nodes
+        contract=args.get('contract', type=float),
 
-    if (mode == 'bus_stops'):
-        print('Adding population data')
-        graph = plot_census_stops(stops)
+        # Stops further than this from any road node are not snapped (intersections mode)
+        snap_distance=args.get('snap_distance', type=float),
 
-        print('Adding edges')
-        G = aco.create_graph_with_distances(graph)
-    elif (mode == 'intersections'):
-        print('Plotting roads')
-        roads = plot_area()
+        # Processes solving routes concurrently
+        route_workers=args.get('route_workers', os.cpu_count() or 1, type=int),
 
-        print('Adding population data')
-        graph = plot_census_intersections(roads)
+        # Seconds the optimisation may run before returning the best routes so far
+        time_limit=args.get('time_limit', type=float),
 
-        print('Adding edges')
-        G = nx.Graph(graph)
-    else:
-        print('ERROR: No mode')
+        # Profile the job with cProfile (needs ACO_PROFILING=1)
+        profile=args.get('profile', 0, type=int) == 1,
 
-    # Iterate through each route
-    routes = 1
-    for start_value, end_value in zip(start_nodes, end_nodes):
-        if(mode == 'bus_stops'):
-            source_node = get_node(G, start_value)
-            destination_node = get_node(G, end_value)
-        elif(mode == 'intersections'):
-            start = get_coords(stops, start_value)
-            end = get_coords(stops, end_value)
+        # 'html' for the folium map page, 'geojson' for just the route lines
+        # with coordinates rounded to precision decimal places
+        format=args.get('format', 'html'),
+        precision=args.get('precision', 6, type=int),
+    )
 
-            source_node = find_node(G, start)
-            destination_node = find_node(G, end)
+    settings['options'] = dict(
+        num_ants=args.get('num_ants', type=int),
+        iterations=args.get('num_iterations', type=int),
+        evaporation_rate=0.2,
 
-        if source_node and destination_node is not None:
-            print('\nRoute number ' + str(routes))
-            routes += 1
+        # ACO engine, 'numpy' (vectorised) or 'python'
+        engine=args.get('engine', 'numpy'),
 
-            G = aco.calc_origin_dist(G, source_node)
-            
-            best_path, best_distance = aco.ant_colony_optimisation(
-                G, source_node, destination_node, num_ants, iterations, evaporation_rate
-            )
+        # Random seed for reproducible runs, and processes constructing ants in parallel (numpy engine)
+        seed=args.get('seed', type=int),
+        workers=args.get('workers', 1, type=int),
 
-            # Append the best path to the array
-            best_paths.append(best_path)
+        # Stop early after this many iterations without improvement, or once
+        # the normalised pheromone entropy falls below min_entropy
+        patience=args.get('patience', type=int),
+        min_entropy=args.get('min_entropy', type=float),
 
-    # Get line output for each best path
-    lines = [LineString(path) for path in best_paths]
+        # Pheromone update: 'as' (every ant), 'elitist', 'rank' or 'mmas'
+        # (Max-Min Ant System), with the trails reinitialised after
+        # restart_after iterations without improvement or once the pheromone
+        # entropy falls below restart_entropy
+        strategy=args.get('strategy', 'as'),
+        restart_after=args.get('restart_after', type=int),
+        restart_entropy=args.get('restart_entropy', type=float),
+
+        # Ants that make more moves than this (including backtracking) are dropped
+        max_steps=args.get('max_steps', type=int),
+
+        # Ants choose from each node's nearest candidates neighbours first
+        candidates=args.get('candidates', type=int),
+
+        # Search only a corridor around each route: 'ellipse', 'buffer' or
+        # 'shortest' (within slack times the shortest path)
+        corridor=args.get('corridor'),
+        slack=args.get('slack', 1.5, type=float),
+
+        # Start from the pheromone of the last run of each route (numpy
+        # engine): 'stored', or 'shortest' to seed new routes along the
+        # shortest path
+        warm_start=args.get('warm_start'),
+    )
+
+    return settings
+
+# Engine options, with the time limit counted from when solving starts
+def solve_options(settings):
+    options = dict(settings['options'])
+    if settings['time_limit'] is not None:
+        options['deadline'] = time.time() + settings['time_limit']
+
+    return options
+
+# Results of routes solved before with the same data snapshot and settings
+# are reused, only the other routes are solved (see route_cache).
+# progress and cancel are passed on to solve_routes
+def solve_cached_routes(settings, progress=None, cancel=None):
+    pairs = list(zip(settings['start_nodes'], settings['end_nodes']))
+    version = data_version(settings)
+
+    # Warm started routes are never cached (see route_cache.cacheable)
+    results = [None] * len(pairs)
+    if not settings['refresh'] and not settings['options'].get('warm_start'):
+        results = [route_cache.routes.get(route_cache.route_key(version, settings, *pair)) for pair in pairs]
+    missing = [i for i, result in enumerate(results) if result is None]
+    metrics.count({'cached_routes': len(pairs) - len(missing)})
+    if not missing:
+        return results
+
+    G, routes = prepare_routes(settings, [pairs[i] for i in missing], version)
+
+    # Building the graph can download layers, giving a new snapshot
+    version = data_version(settings)
+
+    report = None
+    if progress is not None:
+        report = lambda route_index, *update: progress(missing[route_index], *update)
+
+    with metrics.timer('aco'):
+        solved = solve_routes(G, routes, solve_options(settings), settings['route_workers'], report, cancel)
+
+    for i, result in zip(missing, solved):
+        results[i] = result
+        if route_cache.cacheable(result, settings, cancel):
+            route_cache.routes.put(route_cache.route_key(version, settings, *pairs[i]), result)
+
+    return results
+
+# Name of the published graph snapshot for the settings (see snapshots.py),
+# which only the numpy engine can run on
+def published_snapshot(settings):
+    if settings['options']['engine'] == 'python':
+        return None
+
+    return snapshots.snapshot_name(
+        settings['mode'], settings['graph_mode'], settings['neighbours'], settings['radius'], settings['demand'],
+        settings['contract'], regions.default_region().name
+    )
+
+# Version of the data the routes are solved on: the published snapshot's
+# version if there is one, the local data store's otherwise
+def data_version(settings):
+    name = published_snapshot(settings)
+    version = None if name is None else snapshots.current_version(name)
+
+    return version if version is not None else data_store.snapshot_version()
+
+# The published snapshot's memory-mapped arrays, or the graph built from the
+# same data with the same settings, building it if there is none
+def route_graph(settings, version):
+    name = published_snapshot(settings)
+    if name is not None and not settings['refresh']:
+        arrays = snapshots.load_snapshot(name)
+        if arrays is not None:
+            return arrays, arrays
+
+    if not settings['refresh']:
+        cached = route_cache.graphs.get(route_cache.graph_key(version, settings))
+        if cached is not None:
+            return cached
+
+    built = build_graph(settings)
+    route_cache.graphs.put(route_cache.graph_key(data_store.snapshot_version(), settings), built)
+
+    return built
+
+# Find the graph node for the start and end stop of each (start, end) pair
+def prepare_routes(settings, pairs, version):
+    graph, G = route_graph(settings, version)
+
+    return G, graphs.route_nodes(settings['mode'], graph, G, stop_coords, pairs, settings['snap_distance'])
+
+# Build the graph the engine runs on, and the graph the stops are snapped to
+def build_graph(settings):
+    return graphs.build_graph(
+        settings['mode'], stops, settings['options']['engine'], settings['graph_mode'], settings['neighbours'],
+        settings['radius'], settings['refresh'], settings['demand'], settings['contract']
+    )
+
+def run_route_job(job, settings):
+    with metrics.profile('job-' + job.id, settings['profile']):
+        return solve_route_job(job, settings)
+
+def solve_route_job(job, settings):
+    # Send the path only when a route's best distance improves
+    def progress(route_index, iteration, best_path, best_distance):
+        best_distance = best_distance if math.isfinite(best_distance) else None
+
+        improved = job.progress.get(route_index + 1, {}).get('distance') != best_distance
+        job.progress[route_index + 1] = {'iteration': iteration, 'distance': best_distance}
+
+        event = {'route': route_index + 1, 'iteration': iteration, 'distance': best_distance}
+        if improved:
+            event['path'] = quantise(best_path, settings['precision'])
+        job.report('progress', event)
+
+    return solve_cached_routes(settings, progress, job.cancel_event)
+
+def profile_name(endpoint):
+    return endpoint + '-' + time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+
+def route_json(result):
+    return {
+        'source': result['source'],
+        'destination': result['destination'],
+        'distance': result['distance'],
+        'path': None if result['path'] is None else [point.coords[0][:2] for point in result['path']],
+        'error': result['error'],
+        'stats': result['stats'],
+    }
+
+def render_routes(results):
+    # Get line output for each best path, keeping each route's colour even if others failed
+    solved = [(i, result) for i, result in enumerate(results) if result['error'] is None]
+    lines = [route_geometry(result['path']) for _, result in solved]
     line_gdf = gpd.GeoDataFrame(geometry=lines)
 
     # Display line_gdf and origin graph together
     map = pd.concat([stops, line_gdf])
 
     # Create leaflet
-    colours = (['#ABABAB'] * len(stops.index)) + list(islice((cycle(['#0E5A45', '#E1342E', '#6ACAC6', '#8E4A23', '#5B8539', '#D90F7D', '#675297', '#A71E26', '#11B26D', '#F8EA10', '#D6469E', '#BA64AA', '#53A146', '#C77E27', '#125CAB'])), len(line_gdf.index)))
-    figure = generate_map_colour(map, colours)
+    with metrics.timer('render'):
+        colours = (['#ABABAB'] * len(stops.index)) + [ROUTE_COLOURS[i % len(ROUTE_COLOURS)] for i, _ in solved]
+        figure = generate_map_colour(map, colours)
 
-    map_html = figure.get_root()._repr_html_()
-    return map_html
+        map_html = figure.get_root()._repr_html_()
+
+    # Report failed routes without failing the request
+    errors = [
+        {'route': i + 1, 'error': result['error']} for i, result in enumerate(results) if result['error'] is not None
+    ]
+    return map_html, 200, {'X-Route-Errors': json.dumps(errors)}
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,162 @@
+# Headless batch planning of a whole route network, without Flask. Reads a
+# route file like routes.txt (route_num, origin_stop, dest_stop, colour),
+# builds the graph once, solves every route across processes within one
+# overall time budget and writes the routes as GeoJSON or GeoParquet with
+# each route's distance, runtime and iteration count:
+#
+#   python batch_planner.py routes.txt --mode intersections --time-limit 3600 --output network.parquet
+import argparse
+import csv
+import math
+import os
+import threading
+import time
+
+import geopandas as gpd
+
+import aco
+import graphs
+import regions
+from create_display import route_geometry
+from plot_nodes import plot_stops, stop_coordinates
+from routing import solve_routes
+
+
+def read_routes(path):
+    with open(path, newline='') as file:
+        rows = list(csv.DictReader(file, skipinitialspace=True))
+
+    return [
+        {
+            'route': row['route_num'].strip(),
+            'origin': row['origin_stop'].strip(),
+            'destination': row['dest_stop'].strip(),
+            'colour': (row.get('colour') or '').strip() or None,
+        }
+        for row in rows
+    ]
+
+
+# Solve every route, with the time limit (in seconds) counted from the start,
+# so it also covers loading the layers and building the graph. Routes still
+# running when it runs out return their best path so far, as they do when
+# cancel (a threading.Event) is set
+def plan(routes, options, mode='intersections', graph_mode='knn', neighbours=8, radius=None, snap_distance=None,
+         processes=1, time_limit=None, refresh=False, demand=None, contract=None, region=None, cancel=None):
+    options = dict(options)
+    if time_limit is not None:
+        options['deadline'] = time.time() + time_limit
+
+    print('Loading stops')
+    stops = plot_stops(refresh, region)
+
+    graph, G = graphs.build_graph(
+        mode, stops, options.get('engine', 'numpy'), graph_mode, neighbours, radius, refresh, demand, contract, region
+    )
+    pairs = graphs.route_nodes(
+        mode, graph, G, stop_coordinates(stops), [(route['origin'], route['destination']) for route in routes],
+        snap_distance
+    )
+
+    return solve_routes(G, pairs, options, processes, cancel=cancel)
+
+
+def results_frame(routes, results):
+    rows = []
+    for route, result in zip(routes, results):
+        stats = result['stats'] or {}
+        distance = result['distance']
+
+        rows.append({
+            'route': route['route'],
+            'origin': route['origin'],
+            'destination': route['destination'],
+            'colour': route['colour'],
+            'distance': distance if distance is not None and math.isfinite(distance) else None,
+            'runtime': stats.get('solve_seconds'),
+            'iterations': stats.get('iterations', 0),
+            'error': result['error'],
+            'geometry': route_geometry(result['path']),
+        })
+
+    return gpd.GeoDataFrame(rows, geometry='geometry', crs='EPSG:4326')
+
+
+def write_results(frame, path):
+    if path.endswith('.parquet'):
+        frame.to_parquet(path)
+    else:
+        frame.to_file(path, driver='GeoJSON')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Solve every route in a route file without the web app')
+    parser.add_argument('routes', nargs='?', default='routes.txt', help='Route file with route_num, origin_stop, dest_stop, colour')
+    parser.add_argument('--output', default='routes.geojson', help='Output file, GeoParquet if it ends in .parquet, GeoJSON otherwise')
+    parser.add_argument('--mode', default='intersections', choices=graphs.MODES)
+    parser.add_argument('--graph', default='knn', help='Stop graph mode for create_graph_with_distances')
+    parser.add_argument('--neighbours', type=int, default=8)
+    parser.add_argument('--radius', type=float)
+    parser.add_argument('--demand', choices=['demand', 'both'], help='Weight the heuristic by commuter demand')
+    parser.add_argument('--snap-distance', type=float)
+    parser.add_argument('--contract', type=float, metavar='METRES', help='Contract the road graph, merging intersections within METRES')
+    parser.add_argument('--region', help='Area as west,south,east,north or a polygon file, Tauranga by default')
+    parser.add_argument('--tile-size', type=float, help='Load the region in tiles of this many degrees')
+    parser.add_argument('--refresh', action='store_true', help='Download the layers again instead of using the local data store')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Routes solved concurrently')
+    parser.add_argument('--time-limit', type=float, help='Seconds for the whole run, after which the best routes so far are written')
+    parser.add_argument('--engine', default='numpy', choices=['numpy', 'python'])
+    parser.add_argument('--ants', type=int, default=50)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--evaporation-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--workers', type=int, default=1, help='Processes constructing ants for each route (numpy engine)')
+    parser.add_argument('--patience', type=int)
+    parser.add_argument('--strategy', default='as', choices=['as', 'elitist', 'rank', 'mmas'])
+    parser.add_argument('--max-steps', type=int)
+    parser.add_argument('--candidates', type=int)
+    parser.add_argument('--corridor', choices=['ellipse', 'buffer', 'shortest'])
+    parser.add_argument('--slack', type=float, default=1.5)
+    parser.add_argument('--warm-start', choices=['stored', 'shortest'])
+    args = parser.parse_args()
+
+    routes = read_routes(args.routes)
+    region = regions.region_option(args.region, args.tile_size)
+    options = dict(
+        num_ants=args.ants,
+        iterations=args.iterations,
+        evaporation_rate=args.evaporation_rate,
+        engine=args.engine,
+        seed=args.seed,
+        workers=args.workers,
+        patience=args.patience,
+        strategy=args.strategy,
+        max_steps=args.max_steps,
+        candidates=args.candidates,
+        corridor=args.corridor,
+        slack=args.slack,
+        warm_start=args.warm_start,
+    )
+
+    # Ctrl+C stops the routes after their current iteration, and the best
+    # routes so far are written
+    cancel = threading.Event()
+    aco.cancel_on_interrupt(cancel)
+
+    start = time.perf_counter()
+    results = plan(
+        routes, options, args.mode, args.graph, args.neighbours, args.radius, args.snap_distance, args.processes,
+        args.time_limit, args.refresh, args.demand, args.contract, region, cancel
+    )
+    frame = results_frame(routes, results)
+    write_results(frame, args.output)
+
+    print('\n')
+    for row in frame.itertuples():
+        outcome = row.error if row.error is not None else str(round(row.distance, 1)) + ' in ' + str(row.iterations) + ' iterations'
+        print('Route ' + row.route + ': ' + outcome)
+    print('Wrote ' + str(len(frame.index)) + ' routes to ' + args.output + ' in ' + str(round(time.perf_counter() - start, 1)) + 's')
+
+
+if __name__ == '__main__':
+    main()
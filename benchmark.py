@@ -0,0 +1,306 @@
+# Offline benchmarks for the graph building pipeline and the ACO engines.
+# All inputs are generated deterministically from a seed, shaped like the
+# plot_stops, ox.graph_from_bbox and read_census_data outputs, so no network
+# access is needed. Results are written as JSON to compare across commits:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+from shapely.geometry import box
+
+import aco
+import aco_numpy
+import regions
+from plot_nodes import process_data_stops, process_data_intersections, find_node, snap_coordinates
+
+
+tauranga_bounds = regions.TAURANGA.bounds
+
+
+def random_points(n, rng, bounds=tauranga_bounds):
+    xs = rng.uniform(bounds['west'], bounds['east'], n)
+    ys = rng.uniform(bounds['south'], bounds['north'], n)
+    return xs, ys
+
+
+# Bus stops like plot_stops: numeric 'ref' strings with point geometry
+def synthetic_stops(n, seed=0):
+    rng = np.random.default_rng(seed)
+    xs, ys = random_points(n, rng)
+
+    return gpd.GeoDataFrame(
+        {'ref': [str(1000 + i) for i in range(n)], 'name': ['Stop ' + str(i) for i in range(n)]},
+        geometry=gpd.points_from_xy(xs, ys),
+        crs='EPSG:4326',
+    )
+
+
+# Drive network like ox.graph_from_bbox: a MultiDiGraph with x/y on the nodes
+# and length (metres) on edges in both directions. 'grid' is a jittered street
+# grid, 'geometric' joins random intersections to their nearest neighbours
+def synthetic_roads(n, kind='grid', seed=0):
+    rng = np.random.default_rng(seed)
+    roads = nx.MultiDiGraph(crs='epsg:4326')
+
+    if kind == 'grid':
+        side = max(2, int(round(n ** 0.5)))
+        xs = np.linspace(tauranga_bounds['west'], tauranga_bounds['east'], side)
+        ys = np.linspace(tauranga_bounds['south'], tauranga_bounds['north'], side)
+        jitter = (xs[1] - xs[0]) * 0.1
+
+        coords = {}
+        for i in range(side):
+            for j in range(side):
+                coords[i * side + j] = (xs[i] + rng.normal(0, jitter), ys[j] + rng.normal(0, jitter))
+
+        pairs = [(i * side + j, i * side + j + 1) for i in range(side) for j in range(side - 1)]
+        pairs += [(i * side + j, (i + 1) * side + j) for i in range(side - 1) for j in range(side)]
+    elif kind == 'geometric':
+        xs, ys = random_points(n, rng)
+        coords = dict(enumerate(zip(xs, ys)))
+        pairs = aco.connect_components(np.column_stack([xs, ys]), aco.neighbour_pairs(np.column_stack([xs, ys]), 'knn', 3)).tolist()
+    else:
+        raise ValueError("Unknown road graph kind: " + str(kind))
+
+    for node, (x, y) in coords.items():
+        roads.add_node(node + 1, x=float(x), y=float(y), street_count=0)
+
+    for osmid, (a, b) in enumerate(pairs):
+        (x1, y1), (x2, y2) = coords[a], coords[b]
+        length = float(np.hypot((x1 - x2) * 88000, (y1 - y2) * 111000))
+        roads.add_edge(a + 1, b + 1, length=length, osmid=osmid)
+        roads.add_edge(b + 1, a + 1, length=length, osmid=osmid)
+
+    return roads
+
+
+# Meshblocks like read_census_data: a grid of polygons with sum_population
+def synthetic_meshblocks(cells, seed=0):
+    rng = np.random.default_rng(seed)
+    side = max(1, int(round(cells ** 0.5)))
+    xs = np.linspace(tauranga_bounds['west'], tauranga_bounds['east'], side + 1)
+    ys = np.linspace(tauranga_bounds['south'], tauranga_bounds['north'], side + 1)
+
+    polygons = [box(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(side) for j in range(side)]
+    return gpd.GeoDataFrame(
+        {'sum_population': rng.integers(0, 150, len(polygons))}, geometry=polygons, crs='EPSG:4326'
+    )
+
+
+# Time a call, then call it again with tracemalloc tracking peak memory, as
+# tracing slows the call down several times over (most of all numpy code).
+# Returns the timed call's result. reset() is called before each call to
+# undo anything the first call leaves behind that the second would reuse
+def measure(function, *args, reset=None, **kwargs):
+    if reset is not None:
+        reset()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    if reset is not None:
+        reset()
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {'seconds': seconds, 'peak_memory_bytes': peak}
+
+
+def bench_stop_graph(size, graph_mode, seed):
+    stops = process_data_stops(synthetic_stops(size, seed), synthetic_meshblocks(size // 4 or 1, seed))
+    graph, metrics = measure(aco.create_graph_with_distances, stops, graph_mode)
+
+    metrics.update(benchmark='create_graph_with_distances', size=size, graph=graph_mode, edges=graph.number_of_edges())
+    return graph, metrics
+
+
+def bench_census_join(size, kind, seed):
+    roads = synthetic_roads(size, kind, seed)
+    census = synthetic_meshblocks(size // 4 or 1, seed)
+    roads, metrics = measure(process_data_intersections, roads, census)
+
+    metrics.update(benchmark='process_data_intersections', size=size, graph=kind)
+    return roads, metrics
+
+
+# Road graph for each engine as prepare_routes builds it: compact CSR arrays
+# for the numpy engine, an nx.Graph weighted by length for the python engine
+def bench_road_arrays(roads, size, kind):
+    arrays, metrics = measure(aco_numpy.road_graph_to_arrays, roads)
+    metrics.update(benchmark='road_graph_to_arrays', size=size, graph=kind, edges=arrays.num_edges)
+
+    graph = nx.Graph(roads)
+    nx.set_edge_attributes(graph, nx.get_edge_attributes(graph, 'length'), 'weight')
+
+    return graph, arrays, metrics
+
+
+def bench_find_node(graph, size, kind, seed, lookups=100):
+    rng = np.random.default_rng(seed)
+    targets = list(zip(*random_points(lookups, rng)))
+
+    results = []
+    # Each call builds the node index, as the first lookup on a graph does
+    _, metrics = measure(
+        lambda: [find_node(graph, target) for target in targets], reset=lambda: graph.graph.pop('node_index', None)
+    )
+    metrics.update(benchmark='find_node', size=size, graph=kind, lookups=lookups)
+    results.append(metrics)
+
+    _, metrics = measure(snap_coordinates, graph, targets)
+    metrics.update(benchmark='snap_coordinates', size=size, graph=kind, lookups=lookups)
+    results.append(metrics)
+
+    return results
+
+
+# Source and destination far apart: the nodes nearest the south-west and north-east corners
+def far_pair(graph):
+    source, destination = snap_coordinates(
+        graph, [(tauranga_bounds['west'], tauranga_bounds['south']), (tauranga_bounds['east'], tauranga_bounds['north'])]
+    )
+    return source, destination
+
+
+def bench_aco(graph, graph_name, size, engine, num_ants, iterations, seed, arrays=None):
+    source, destination = far_pair(graph)
+    optimum = nx.shortest_path_length(graph, source, destination, weight='weight')
+
+    # Each run counts its own stats, so they match the timed run
+    def run():
+        stats = {}
+        if engine == 'python':
+            _, best_distance = aco.ant_colony_optimisation(
+                graph, source, destination, num_ants, iterations, 0.2, stats=stats
+            )
+        else:
+            _, best_distance = aco_numpy.ant_colony_optimisation(
+                arrays, source, destination, num_ants, iterations, 0.2, seed=seed, stats=stats
+            )
+        return best_distance, stats
+
+    if engine != 'python' and arrays is None:
+        arrays = aco_numpy.graph_to_arrays(graph)
+    (best_distance, stats), metrics = measure(run)
+
+    metrics.update(
+        benchmark='ant_colony_optimisation',
+        size=size,
+        graph=graph_name,
+        edges=graph.number_of_edges(),
+        engine=engine,
+        ants=num_ants,
+        iterations=iterations,
+        ant_steps=stats.get('ant_steps', 0),
+        ant_steps_per_second=stats.get('ant_steps', 0) / metrics['seconds'],
+        failed_ants=stats.get('failed_ants', 0),
+        best_distance=best_distance,
+        optimum=optimum,
+        quality=optimum / best_distance if best_distance > 0 else 1.0,
+    )
+    return metrics
+
+
+def run_benchmarks(sizes, ant_counts, iteration_counts, engines, graph_modes, road_kinds, seed=0):
+    results = []
+    for size in sizes:
+        for graph_mode in graph_modes:
+            print('Stop graph, ' + graph_mode + ', ' + str(size) + ' stops')
+            graph, metrics = bench_stop_graph(size, graph_mode, seed)
+            results.append(metrics)
+
+            for engine in engines:
+                for num_ants in ant_counts:
+                    for iterations in iteration_counts:
+                        results.append(bench_aco(graph, 'stops-' + graph_mode, size, engine, num_ants, iterations, seed))
+
+        for kind in road_kinds:
+            print('Road graph, ' + kind + ', ' + str(size) + ' intersections')
+            roads, metrics = bench_census_join(size, kind, seed)
+            results.append(metrics)
+            results.extend(bench_find_node(roads, size, kind, seed))
+
+            graph, arrays, metrics = bench_road_arrays(roads, size, kind)
+            results.append(metrics)
+
+            for engine in engines:
+                for num_ants in ant_counts:
+                    for iterations in iteration_counts:
+                        results.append(
+                            bench_aco(graph, 'roads-' + kind, size, engine, num_ants, iterations, seed, arrays)
+                        )
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Key identifying a benchmark case across result files
+def case_key(result):
+    fields = ('benchmark', 'size', 'graph', 'engine', 'ants', 'iterations', 'lookups')
+    return tuple(result.get(field) for field in fields)
+
+
+def compare(baseline, results):
+    baseline_cases = {case_key(result): result for result in baseline['results']}
+    for result in results:
+        before = baseline_cases.get(case_key(result))
+        if before is None:
+            continue
+
+        name = ', '.join(str(value) for value in case_key(result) if value is not None)
+        ratio = result['seconds'] / before['seconds'] if before['seconds'] > 0 else float('inf')
+        print(name + ': ' + str(round(before['seconds'], 4)) + 's -> ' + str(round(result['seconds'], 4)) + 's (x' + str(round(ratio, 2)) + ')')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark graph building and the ACO engines on synthetic data')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[200, 1000])
+    parser.add_argument('--ants', nargs='+', type=int, default=[50])
+    parser.add_argument('--iterations', nargs='+', type=int, default=[10])
+    parser.add_argument('--engines', nargs='+', default=['numpy'], choices=['numpy', 'python'])
+    parser.add_argument('--graphs', nargs='+', default=['knn'], help='Stop graph modes for create_graph_with_distances')
+    parser.add_argument('--roads', nargs='+', default=['grid', 'geometric'], choices=['grid', 'geometric'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help='Earlier results file to compare timings against')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.ants, args.iterations, args.engines, args.graphs, args.roads, args.seed)
+
+    report = {
+        'commit': git_commit(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'networkx': nx.__version__,
+        'arguments': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('\nWrote ' + str(len(results)) + ' results to ' + args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,76 +1,156 @@
-# Importing GIS libraries
+# Commuter demand from the 2018 census means of travel to work by statistical
+# area (SA2). The full origin-destination matrix of commutes between the SA2s
+# of the area is built in one grouped pass, cached in the local data store,
+# and turned into a demand for each stop or road node, which graphs.py can use
+# in place of or alongside the census population in the ant heuristic
+import argparse
+import hashlib
+import os
+import uuid
+
 import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import data_store
+import regions
+
+
+SA2_SHAPEFILE = "data/statsnz-statistical-area-2-2018-generalised-SHP/statistical-area-2-2018-generalised.shp"
+COMMUTE_CSV = "data/statsnz-2018-census-main-means-of-travel-to-work-by-statistical-area-CSV/2018-census-main-means-of-travel-to-work-by-statistical-area.csv"
+
+AREA_COLUMN = "SA22018__1"  # Statistical area 2 place name column
+RESIDENCE_COLUMN = "SA2_name_usual_residence_address"
+WORKPLACE_COLUMN = "SA2_name_workplace_address"
+
+# 'demand' uses the commuter demand in place of the census population,
+# 'both' the mean of the two
+DEMAND_MODES = ('demand', 'both')
+
+# Population of nodes outside every meshblock, as in the ant heuristic
+DEFAULT_POPULATION = 60
+
+# The ant heuristic normalises population from this minimum, anything lower
+# would make it negative
+MIN_POPULATION = 6
+
+
+# Load the statistical areas overlapping the region (see regions.py) in
+# WGS84, one row per area. The shapefile is in EPSG:2193, geopandas projects
+# the region's shape to match
+def read_statistical_areas(region=None, path=SA2_SHAPEFILE):
+    region = region or regions.default_region()
+    areas = gpd.read_file(path, mask=region.geoseries()).to_crs(4326)
+    areas = areas[[AREA_COLUMN, areas.geometry.name]].rename(columns={AREA_COLUMN: 'area'})
 
-# Define map boundaries for Tauranga, New Zealand
-tauranga_bounds = {
-    "north": -37.6039,
-    "east": 176.5125,
-    "south": -37.8114,
-    "west": 176.0593,
-}
-
-# Census data is in ESPG:2193, these bounds are similar to the ones above
-tauranga_bbox = (
-    1869316.8619308192,
-    5810699.85703883,
-    1910089.458412611,
-    5832327.558897601,
-)  # Format: min x, min y, max x, max y
-
-# Load the geographical data from a shapefile and convert it to WGS84 coordinate reference system
-statistical_area_data = gpd.read_file(
-    "data/statsnz-statistical-area-2-2018-generalised-SHP/statistical-area-2-2018-generalised.shp",
-    bbox=tauranga_bbox,
-)
-statistical_area_data = statistical_area_data.to_crs(4326)
-
-# Extract unique statistical areas
-statistical_areas = statistical_area_data["SA22018__1"].unique().tolist() # Statistical area 2 place name column
-
-# Load census data and filter based on statistical areas
-census_data = gpd.read_file(
-    "data/statsnz-2018-census-main-means-of-travel-to-work-by-statistical-area-CSV/2018-census-main-means-of-travel-to-work-by-statistical-area.csv"
-)
-census_data = census_data[
-    census_data["SA2_name_usual_residence_address"].isin(statistical_areas) # Is SA2 place name
-]
-
-# Drop unnecessary columns from the census data
-census_data_filtered = census_data.drop(
-    columns=[
-        "SA2_code_usual_residence_address",
-        "SA2_usual_residence_easting",
-        "SA2_usual_residence_northing",
-        "SA2_code_workplace_address",
-        "SA2_workplace_easting",
-        "SA2_workplace_northing",
-        "Work_at_home",
-        "Drive_a_private_car_truck_or_van",
-        "Drive_a_company_car_truck_or_van",
-        "Passenger_in_a_car_truck_van_or_company_bus",
-        "Public_bus",
-        "Train",
-        "Bicycle",
-        "Walk_or_jog",
-        "Ferry",
-        "Other",
-        "geometry",
-    ]
-)
-
-# Display the filtered census data
-print("All commutes:")
-print(census_data_filtered)
-
-# Calculate and display arrival counts for each statistical area
-arrival_counts = [["Area", "Arrivals"]]
-for area in statistical_areas:
-    count = sum(
-        (census_data[census_data["SA2_name_workplace_address"] == area])["Total"] # Is SA2 place name
+    return areas.drop_duplicates(subset='area').reset_index(drop=True)
+
+
+def read_commutes(path=COMMUTE_CSV):
+    commutes = pd.read_csv(path, usecols=[RESIDENCE_COLUMN, WORKPLACE_COLUMN, 'Total'])
+
+    # Confidential counts are negative (-999)
+    commutes['Total'] = pd.to_numeric(commutes['Total'], errors='coerce').fillna(0).clip(lower=0)
+
+    return commutes
+
+
+# Commutes from each area (rows) to each area (columns), for the given area names
+def od_matrix(commutes, areas):
+    origins = pd.Categorical(commutes[RESIDENCE_COLUMN], categories=areas).codes.astype(np.int64)
+    destinations = pd.Categorical(commutes[WORKPLACE_COLUMN], categories=areas).codes.astype(np.int64)
+    inside = (origins >= 0) & (destinations >= 0)
+
+    n = len(areas)
+    flat = np.bincount(
+        origins[inside] * n + destinations[inside], weights=commutes['Total'].to_numpy(dtype=float)[inside],
+        minlength=n * n
     )
-    arrival_counts.append([area, str(count)])
 
-# Print number of people arriving in each area
-print(arrival_counts)
+    return flat.reshape(n, n)
+
+
+# The matrix only changes with the census files and the region, so it is
+# cached with them in its name
+def matrix_path(region, paths):
+    shape = None if region.polygon is None else region.polygon.wkb_hex
+    key = [region.bbox(), shape] + [(path, os.path.getmtime(path), os.path.getsize(path)) for path in paths]
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+    return os.path.join(data_store.CACHE_DIR, 'commute_od_' + digest + '.npz')
+
+# Area names and their origin-destination matrix, from the cache if possible
+def load_od_matrix(region=None, shapefile=SA2_SHAPEFILE, csv=COMMUTE_CSV, refresh=False):
+    region = region or regions.default_region()
+    path = matrix_path(region, [shapefile, csv])
+    if os.path.exists(path) and not refresh:
+        with np.load(path) as cached:
+            return cached['areas'].tolist(), cached['matrix']
+
+    areas = read_statistical_areas(region, shapefile)['area'].tolist()
+    matrix = od_matrix(read_commutes(csv), areas)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        np.savez(file, areas=np.array(areas), matrix=matrix)
+    os.replace(temporary_path, path)
+
+    return areas, matrix
+
+
+# Trips starting or ending in each area
+def area_demand(areas, matrix):
+    return pd.Series(matrix.sum(axis=1) + matrix.sum(axis=0), index=areas)
+
+
+# Demand of each point (stop or road node), its area's demand shared equally
+# between the points in the area. Points outside every area have none
+def point_demand(points, region=None, refresh=False):
+    region = region or regions.default_region()
+    areas, matrix = load_od_matrix(region, refresh=refresh)
+    demand = area_demand(areas, matrix)
+
+    points = gpd.GeoDataFrame(geometry=gpd.GeoSeries(points, crs=4326).reset_index(drop=True))
+    joined = gpd.sjoin(points, read_statistical_areas(region), how='left', predicate='within')
+    area = joined[~joined.index.duplicated()]['area']
+
+    shares = area.map(area.value_counts())
+    return (area.map(demand) / shares).fillna(0).to_numpy(dtype=float)
+
+
+# Population used by the ant heuristic: the census population, the demand
+# scaled to the same mean, or the mean of the two, no lower than the
+# heuristic's minimum. Done once per graph, so demand weighting costs nothing
+# per ant step
+def demand_population(population, demand, mode):
+    if mode not in DEMAND_MODES:
+        raise ValueError('Unknown demand mode: ' + str(mode) + ', use one of ' + ', '.join(DEMAND_MODES))
+
+    population = np.asarray(population, dtype=float)
+    population = np.where(np.isnan(population), DEFAULT_POPULATION, population)
+    if demand.sum() <= 0:
+        return population
+
+    scaled = demand * population.mean() / demand.mean()
+    weighted = scaled if mode == 'demand' else (population + scaled) / 2
+    return np.maximum(weighted, MIN_POPULATION)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Commuter arrivals per statistical area')
+    parser.add_argument('--region', help='Area as west,south,east,north or a polygon file, Tauranga by default')
+    parser.add_argument('--refresh', action='store_true', help='Rebuild the cached origin-destination matrix')
+    args = parser.parse_args()
+
+    areas, matrix = load_od_matrix(regions.region_option(args.region), refresh=args.refresh)
+
+    # Print number of people arriving in each area
+    arrivals = pd.Series(matrix.sum(axis=0), index=areas).sort_values(ascending=False)
+    print(arrivals.to_string())
+
+    print("Number of statistical areas:", len(areas))
+
 
-print("Number of statistical areas:", len(statistical_areas))
+if __name__ == '__main__':
+    main()
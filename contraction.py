@@ -0,0 +1,243 @@
+# Road graph contraction for intersections mode. Intersections closer than a
+# tolerance are merged into one, and chains of degree-2 nodes become single
+# edges with the summed length, so ants take fewer, longer steps. The street
+# polyline of every contracted edge is kept (EdgeGeometry), and expand_path
+# turns a path over the contracted graph back into the full street line
+import math
+from collections import defaultdict
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from shapely.geometry import Point
+
+
+# Metres per degree of latitude, and of longitude at the equator
+METRES_PER_DEGREE = 111320.0
+
+
+# Polylines of the contracted edges as flat arrays, which can be memory-mapped
+# like the graph arrays (see snapshots.py). Edge i runs through
+# coords[indptr[i]:indptr[i + 1]], ends holds its first and last point
+class EdgeGeometry:
+    def __init__(self, ends, indptr, coords):
+        self.ends = ends
+        self.indptr = indptr
+        self.coords = coords
+        self._lookup = None
+
+    @classmethod
+    def from_polylines(cls, polylines):
+        indptr = np.zeros(len(polylines) + 1, dtype=np.int64)
+        np.cumsum([len(polyline) for polyline in polylines], out=indptr[1:])
+        coords = np.concatenate(polylines) if polylines else np.empty((0, 2))
+        ends = np.array([np.concatenate([polyline[0], polyline[-1]]) for polyline in polylines]).reshape(-1, 4)
+
+        return cls(ends, indptr, coords)
+
+    # (x0, y0, x1, y1) -> edge, built on first use
+    @property
+    def lookup(self):
+        if self._lookup is None:
+            self._lookup = {tuple(end): i for i, end in enumerate(np.asarray(self.ends).tolist())}
+        return self._lookup
+
+    # Polyline from a to b (coordinate pairs), None if no edge has one
+    def polyline(self, a, b):
+        i = self.lookup.get((a[0], a[1], b[0], b[1]))
+        if i is not None:
+            return self.coords[self.indptr[i]:self.indptr[i + 1]]
+
+        i = self.lookup.get((b[0], b[1], a[0], a[1]))
+        if i is not None:
+            return self.coords[self.indptr[i]:self.indptr[i + 1]][::-1]
+
+        return None
+
+
+# Replace each step of a path of Points with its street polyline
+def expand_path(points, geometry):
+    if geometry is None or len(points) < 2:
+        return points
+
+    coordinates = [point.coords[0][:2] for point in points]
+    expanded = [coordinates[0]]
+    for a, b in zip(coordinates, coordinates[1:]):
+        polyline = geometry.polyline(a, b)
+        expanded.extend([b] if polyline is None else [tuple(xy) for xy in polyline.tolist()[1:]])
+
+    return [Point(xy) for xy in expanded]
+
+
+# Contract an osmnx road graph (after process_data_intersections) into an
+# undirected nx.Graph with the same node attributes (x, y, pos and
+# sum_population) and length on the edges, plus the edge polylines in
+# graph.graph['edge_geometry']. Intersections within tolerance metres of each
+# other are consolidated first (tolerance 0 only contracts chains).
+# sum_population is the population of the meshblock a node lies in rather
+# than a count per node, so merged nodes keep the largest of their members'
+def contract_road_graph(roads, tolerance=10.0, weight='length'):
+    nodes = list(roads.nodes())
+    index = {node: i for i, node in enumerate(nodes)}
+    xy = np.array([(roads.nodes[node]['x'], roads.nodes[node]['y']) for node in nodes], dtype=float).reshape(-1, 2)
+    population = np.array([roads.nodes[node].get('sum_population', np.nan) for node in nodes], dtype=float)
+
+    edges = undirected_edges(roads, index, xy, weight)
+    representative = consolidate(xy, edges, tolerance)
+    edges = merge_nodes(edges, representative, xy)
+
+    # Members' population goes to their representative
+    merged_population = np.full(len(nodes), np.nan)
+    np.fmax.at(merged_population, representative, population)
+
+    edges = contract_chains(edges, merged_population)
+
+    graph = nx.Graph(crs=roads.graph.get('crs'))
+    survivors = sorted({i for edge in edges for i in edge})
+    for i in survivors:
+        attributes = dict(x=xy[i, 0], y=xy[i, 1], pos=(xy[i, 0], xy[i, 1]))
+        if not np.isnan(merged_population[i]):
+            attributes['sum_population'] = merged_population[i]
+        graph.add_node(nodes[i], **attributes)
+
+    polylines = []
+    for (a, b), (length, polyline) in edges.items():
+        graph.add_edge(nodes[a], nodes[b], length=length)
+        polylines.append(polyline)
+    graph.graph['edge_geometry'] = EdgeGeometry.from_polylines(polylines)
+
+    return graph
+
+
+# Shortest edge between each pair of nodes as {(i, j): (length, polyline from
+# i to j)} with i < j, using the osmnx edge geometry where there is one
+def undirected_edges(roads, index, xy, weight):
+    edges = {}
+    for u, v, data in roads.edges(data=True):
+        i, j = index[u], index[v]
+        if i == j:
+            continue
+
+        line = data.get('geometry')
+        polyline = xy[[i, j]] if line is None else np.asarray(line.coords, dtype=float)[:, :2]
+        if i > j:
+            i, j, polyline = j, i, polyline[::-1]
+
+        length = data.get(weight, 1.0)
+        if (i, j) not in edges or length < edges[(i, j)][0]:
+            edges[(i, j)] = (length, polyline)
+
+    return edges
+
+
+# Representative of each node: nodes within tolerance metres of each other
+# (transitively) are merged into the member with the most edges
+def consolidate(xy, edges, tolerance):
+    n = len(xy)
+    if tolerance <= 0 or n < 2:
+        return np.arange(n)
+
+    metres = (xy - xy.mean(axis=0)) * METRES_PER_DEGREE
+    metres[:, 0] *= math.cos(math.radians(xy[:, 1].mean()))
+    pairs = cKDTree(metres).query_pairs(tolerance, output_type='ndarray')
+
+    adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(adjacency, directed=False)
+
+    degree = np.bincount(np.array(list(edges), dtype=np.int64).reshape(-1), minlength=n)
+    order = np.lexsort((-degree, labels))
+    first = np.ones(n, dtype=bool)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+
+    chosen = np.empty(labels.max() + 1, dtype=np.int64)
+    chosen[labels[order][first]] = order[first]
+
+    return chosen[labels]
+
+
+# Move edges onto their ends' representatives, extending their polylines (and
+# lengths) to the representative and dropping edges inside a merged node
+def merge_nodes(edges, representative, xy):
+    merged = {}
+    for (i, j), (length, polyline) in edges.items():
+        a, b = representative[i], representative[j]
+        if a == b:
+            continue
+
+        if a != i:
+            polyline = np.vstack([xy[a], polyline])
+            length += distance(xy[a], xy[i])
+        if b != j:
+            polyline = np.vstack([polyline, xy[b]])
+            length += distance(xy[j], xy[b])
+        if a > b:
+            a, b, polyline = b, a, polyline[::-1]
+
+        if (a, b) not in merged or length < merged[(a, b)][0]:
+            merged[(a, b)] = (length, polyline)
+
+    # Polylines start and end exactly on their nodes, so expand_path finds them
+    for (a, b), (length, polyline) in merged.items():
+        polyline = np.array(polyline, dtype=float)
+        polyline[0], polyline[-1] = xy[a], xy[b]
+        merged[(a, b)] = (length, polyline)
+
+    return merged
+
+
+# Replace each chain of degree-2 nodes with one edge between the nodes at its
+# ends, which take the largest population along the chain. Rings made only of
+# degree-2 nodes have no ends and are dropped, as are chains that loop back
+# to where they started
+def contract_chains(edges, population):
+    neighbours = defaultdict(list)
+    for a, b in edges:
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+
+    contracted = {}
+    walked = set()
+    for start in neighbours:
+        if len(neighbours[start]) == 2:
+            continue
+
+        for node in neighbours[start]:
+            if (min(start, node), max(start, node)) in walked:
+                continue
+
+            previous, length, polylines, chain_population = start, 0.0, [], np.nan
+            while True:
+                key = (min(previous, node), max(previous, node))
+                walked.add(key)
+                edge_length, polyline = edges[key]
+                length += edge_length
+                polylines.append(polyline if previous < node else polyline[::-1])
+
+                if len(neighbours[node]) != 2 or node == start:
+                    break
+                chain_population = np.fmax(chain_population, population[node])
+                previous, node = node, next(other for other in neighbours[node] if other != previous)
+
+            if node == start:
+                continue
+
+            population[start] = np.fmax(population[start], chain_population)
+            population[node] = np.fmax(population[node], chain_population)
+
+            polyline = np.concatenate([polylines[0]] + [polyline[1:] for polyline in polylines[1:]])
+            a, b = (start, node) if start < node else (node, start)
+            if start > node:
+                polyline = polyline[::-1]
+            if (a, b) not in contracted or length < contracted[(a, b)][0]:
+                contracted[(a, b)] = (length, polyline)
+
+    return contracted
+
+
+# Approximate distance in metres between two (longitude, latitude) points
+def distance(a, b):
+    dx = (a[0] - b[0]) * METRES_PER_DEGREE * math.cos(math.radians((a[1] + b[1]) / 2))
+    dy = (a[1] - b[1]) * METRES_PER_DEGREE
+    return math.hypot(dx, dy)
@@ -0,0 +1,133 @@
+# Per-route working subgraphs. Before the ants run, each route's graph is cut
+# down to a corridor around its source and destination, so the walks and the
+# origin heuristic only cover the part of the city that matters. Works on both
+# networkx graphs (python engine) and GraphArrays (numpy engine)
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+
+from aco_numpy import GraphArrays
+
+
+# 'ellipse' keeps nodes whose distance to the source plus distance to the
+# destination is at most slack times the straight-line distance, 'buffer'
+# keeps nodes within (slack - 1) times that distance of the straight line and
+# 'shortest' keeps nodes on a path at most slack times the shortest path
+SHAPES = ('ellipse', 'buffer', 'shortest')
+
+# Smallest corridor half-width, in coordinate units (degrees), for routes
+# whose ends are very close together
+MIN_WIDTH = 0.005
+
+
+# The corridor is widened (its slack doubled above 1) until it contains a path
+# from source to destination, using the whole graph after attempts tries
+def corridor_subgraph(graph, source, destination, shape='ellipse', slack=1.5, attempts=4):
+    if shape not in SHAPES:
+        raise ValueError('Unknown corridor shape: ' + str(shape) + ', use one of ' + ', '.join(SHAPES))
+
+    arrays = graph if isinstance(graph, GraphArrays) else None
+    nodes = list(graph.nodes()) if arrays is None else None
+    index = arrays.index if arrays is not None else {node: i for i, node in enumerate(nodes)}
+    source_id, destination_id = index[source], index[destination]
+
+    if shape == 'shortest':
+        lengths = path_lengths(graph, arrays, nodes, index, source, destination)
+    else:
+        lengths = None
+        if arrays is not None:
+            coords = arrays.coords
+        else:
+            coords = np.array([graph.nodes[node]['pos'][:2] for node in nodes], dtype=float).reshape(-1, 2)
+
+    for _ in range(attempts):
+        if shape == 'shortest':
+            keep = within_shortest(lengths, destination_id, slack)
+        else:
+            keep = within_shape(coords, coords[source_id], coords[destination_id], shape, slack)
+        keep[[source_id, destination_id]] = True
+
+        if arrays is not None:
+            subgraph = array_subgraph(arrays, keep)
+        else:
+            subgraph = graph.subgraph([node for node, kept in zip(nodes, keep) if kept]).copy()
+
+        if connects(subgraph, source, destination):
+            return subgraph
+
+        slack = 1 + 2 * (slack - 1)
+
+    return graph
+
+
+def within_shape(coords, source_xy, destination_xy, shape, slack):
+    span = np.hypot(*(destination_xy - source_xy))
+
+    if shape == 'ellipse':
+        total = np.hypot(*(coords - source_xy).T) + np.hypot(*(coords - destination_xy).T)
+        return total <= slack * span + 2 * MIN_WIDTH
+
+    # Distance from each node to the source-destination segment
+    direction = destination_xy - source_xy
+    along = np.clip((coords - source_xy) @ direction / max(span ** 2, 1e-24), 0, 1)
+    nearest = source_xy + along[:, None] * direction
+    return np.hypot(*(coords - nearest).T) <= max((slack - 1) * span, MIN_WIDTH)
+
+
+# Shortest path length from the source and to the destination for each node
+def path_lengths(graph, arrays, nodes, index, source, destination):
+    if arrays is not None:
+        matrix = csr_matrix((arrays.weights, arrays.indices, arrays.indptr), shape=(arrays.num_nodes,) * 2)
+        return dijkstra(matrix, directed=False, indices=[index[source], index[destination]])
+
+    lengths = np.full((2, len(nodes)), np.inf)
+    for row, end in enumerate((source, destination)):
+        for node, length in nx.single_source_dijkstra_path_length(graph, end, weight='weight').items():
+            lengths[row, index[node]] = length
+    return lengths
+
+def within_shortest(lengths, destination_id, slack):
+    shortest = lengths[0, destination_id]
+    return lengths[0] + lengths[1] <= slack * shortest
+
+
+# Subgraph of the nodes in keep, with the node labels of the full graph
+def array_subgraph(arrays, keep):
+    new_id = np.full(arrays.num_nodes, -1, dtype=np.int64)
+    new_id[keep] = np.arange(np.count_nonzero(keep))
+
+    src = np.repeat(np.arange(arrays.num_nodes), np.diff(arrays.indptr))
+    kept = keep[src] & keep[arrays.indices]
+
+    # Entries stay in (source, weight) order, so candidate lists still hold
+    indptr = np.zeros(np.count_nonzero(keep) + 1, dtype=arrays.indptr.dtype)
+    np.cumsum(np.bincount(new_id[src[kept]], minlength=indptr.size - 1), out=indptr[1:])
+    indices = new_id[arrays.indices[kept]].astype(arrays.indices.dtype)
+    _, edge_ids = np.unique(arrays.edge_ids[kept], return_inverse=True)
+
+    if isinstance(arrays.nodes, np.ndarray):
+        nodes = arrays.nodes[keep]
+    else:
+        nodes = [arrays.nodes[i] for i in np.flatnonzero(keep)]
+
+    return GraphArrays(
+        nodes,
+        indptr,
+        indices,
+        arrays.weights[kept],
+        edge_ids.astype(arrays.edge_ids.dtype),
+        arrays.population[keep],
+        arrays.coords[keep],
+    )
+
+
+def connects(graph, source, destination):
+    if isinstance(graph, GraphArrays):
+        matrix = csr_matrix(
+            (np.ones(graph.indices.size), graph.indices, graph.indptr), shape=(graph.num_nodes,) * 2
+        )
+        _, labels = connected_components(matrix, directed=False)
+        return labels[graph.index[source]] == labels[graph.index[destination]]
+
+    return nx.has_path(graph, source, destination)
@@ -1,7 +1,85 @@
+import json
+import math
+
+from shapely.geometry import LineString, Point
+
+
+# Base map tiles, shared by the folium maps and the Leaflet map in index.html
+TILES = 'https://api.mapbox.com/styles/v1/bj65/clrqu3sys004n01r15x8n4qb1/tiles/256/{z}/{x}/{y}@2x?access_token=sk.eyJ1IjoiYmo2NSIsImEiOiJjbHJxdm5oODkwN2c5MmpxbnR2aWF6YWk2In0.YH9URMfcHwNN2daFqv8UvQ'
+ATTRIBUTION = 'MapBox, OpenStreetMap, StatsNZ'
+
+# Route line colours, route i is drawn in ROUTE_COLOURS[i % len(ROUTE_COLOURS)]
+ROUTE_COLOURS = ['#0E5A45', '#E1342E', '#6ACAC6', '#8E4A23', '#5B8539', '#D90F7D', '#675297', '#A71E26', '#11B26D', '#F8EA10', '#D6469E', '#BA64AA', '#53A146', '#C77E27', '#125CAB']
+
+# Geometry of a route's path. A route whose origin and destination snap to
+# the same node has a one point path, which is not a line
+def route_geometry(path):
+    if not path:
+        return None
+    if len(path) == 1:
+        return Point(path[0])
+
+    return LineString(path)
+
 def generate_map(joined_data):
-    map_figure = joined_data.explore(tiles='https://api.mapbox.com/styles/v1/bj65/clrqu3sys004n01r15x8n4qb1/tiles/256/{z}/{x}/{y}@2x?access_token=sk.eyJ1IjoiYmo2NSIsImEiOiJjbHJxdm5oODkwN2c5MmpxbnR2aWF6YWk2In0.YH9URMfcHwNN2daFqv8UvQ', attr='MapBox, OpenStreetMap, StatsNZ')  # Requires folium, matplotlib, and mapclassify
+    map_figure = joined_data.explore(tiles=TILES, attr=ATTRIBUTION)  # Requires folium, matplotlib, and mapclassify
     return map_figure
 
 def generate_map_colour(joined_data, colour):
-    map_figure = joined_data.explore(color=colour, tiles='https://api.mapbox.com/styles/v1/bj65/clrqu3sys004n01r15x8n4qb1/tiles/256/{z}/{x}/{y}@2x?access_token=sk.eyJ1IjoiYmo2NSIsImEiOiJjbHJxdm5oODkwN2c5MmpxbnR2aWF6YWk2In0.YH9URMfcHwNN2daFqv8UvQ', attr='MapBox, OpenStreetMap, StatsNZ')  # Requires folium, matplotlib, and mapclassify
-    return map_figure
\ No newline at end of file
+    map_figure = joined_data.explore(color=colour, tiles=TILES, attr=ATTRIBUTION)  # Requires folium, matplotlib, and mapclassify
+    return map_figure
+
+# Compact GeoJSON for the Leaflet map. Coordinates are rounded to precision
+# decimal places (5 is about 1 m), which keeps responses small
+def quantise(coordinates, precision=6):
+    return [[round(x, precision), round(y, precision)] for x, y in coordinates]
+
+def stops_geojson(stops, precision=6):
+    names = stops['name'] if 'name' in stops.columns else [None] * len(stops.index)
+
+    features = []
+    for ref, name, point in zip(stops['ref'], names, stops.geometry.representative_point()):
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': quantise([(point.x, point.y)], precision)[0]},
+            'properties': {'ref': text_or_none(ref), 'name': text_or_none(name)},
+        })
+    return dumps_geojson(features)
+
+# Missing tags are NaN, which is not valid JSON
+def text_or_none(value):
+    if value is None or value != value:
+        return None
+    return str(value)
+
+# Routes as LineStrings with their colour, failed routes have no geometry
+def routes_geojson(results, precision=6):
+    features = []
+    for i, result in enumerate(results):
+        coordinates = [point.coords[0][:2] for point in result['path'] or []]
+        distance = result['distance']
+
+        # A LineString needs two positions, one point paths are Points as in route_geometry
+        if not coordinates:
+            geometry = None
+        elif len(coordinates) == 1:
+            geometry = {'type': 'Point', 'coordinates': quantise(coordinates, precision)[0]}
+        else:
+            geometry = {'type': 'LineString', 'coordinates': quantise(coordinates, precision)}
+
+        features.append({
+            'type': 'Feature',
+            'geometry': geometry,
+            'properties': {
+                'route': i + 1,
+                'source': result['source'],
+                'destination': result['destination'],
+                'distance': distance if distance is not None and math.isfinite(distance) else None,
+                'error': result['error'],
+                'colour': ROUTE_COLOURS[i % len(ROUTE_COLOURS)],
+            },
+        })
+    return dumps_geojson(features)
+
+def dumps_geojson(features):
+    return json.dumps({'type': 'FeatureCollection', 'features': features}, separators=(',', ':'), default=str)
@@ -0,0 +1,187 @@
+# Offline-first local store for the OSM roads, OSM bus stops and census
+# meshblock layers. Layers are keyed by source and bounding box and kept as
+# GeoParquet (GraphML for the road graph), so they only need downloading once
+import argparse
+import hashlib
+import os
+import time
+import uuid
+
+import geopandas as gpd
+import osmnx as ox
+from shapely.geometry import box
+
+import metrics
+
+
+CACHE_DIR = os.environ.get('ACO_CACHE_DIR', os.path.join('data', 'cache'))
+
+# Cached layers older than this (in seconds) are downloaded again
+CACHE_TTL = float(os.environ.get('ACO_CACHE_TTL', 30 * 24 * 3600))
+
+# Never download, only use cached or imported layers
+OFFLINE = os.environ.get('ACO_OFFLINE', '0') not in ('', '0')
+
+SOURCES = ('roads', 'stops', 'census')
+GRAPH_SOURCES = ('roads',)
+
+
+def cache_path(source, bounds):
+    name = '{}_{west:.5f}_{south:.5f}_{east:.5f}_{north:.5f}'.format(source, **bounds)
+    extension = '.graphml' if source in GRAPH_SOURCES else '.parquet'
+
+    return os.path.join(CACHE_DIR, name + extension)
+
+
+def is_fresh(path, max_age=None):
+    max_age = CACHE_TTL if max_age is None else max_age
+    return time.time() - os.path.getmtime(path) <= max_age
+
+
+# Version of the local data store, which changes whenever a layer is
+# downloaded, imported or cleared, for caching anything built from the layers
+def snapshot_version():
+    if not os.path.isdir(CACHE_DIR):
+        return None
+
+    layers = []
+    for name in sorted(os.listdir(CACHE_DIR)):
+        if not name.endswith('.tmp'):
+            stat = os.stat(os.path.join(CACHE_DIR, name))
+            layers.append((name, stat.st_mtime_ns, stat.st_size))
+
+    return hashlib.blake2b(repr(layers).encode(), digest_size=16).hexdigest()
+
+
+# Load a layer from the cache, downloading it with download(bounds) if it is
+# missing, stale or refresh is set. A stale copy is used if the download fails.
+# Offline, the cached copy is always used, refresh or not
+def load_layer(source, bounds, download, refresh=False, max_age=None):
+    path = cache_path(source, bounds)
+    cached = os.path.exists(path)
+
+    if cached and (OFFLINE or (not refresh and is_fresh(path, max_age))):
+        if OFFLINE and refresh:
+            print('Offline, using cached ' + source + ' layer instead of refreshing it')
+        with metrics.timer(source + '_read'):
+            return read_layer(path)
+
+    if OFFLINE:
+        raise FileNotFoundError('No cached ' + source + ' layer for ' + str(bounds) + ', import one with data_store.py')
+
+    try:
+        with metrics.timer(source + '_download'):
+            layer = download(bounds)
+    except Exception:
+        if not cached:
+            raise
+        print('Download failed, using cached ' + source + ' layer')
+        return read_layer(path)
+
+    write_layer(layer, path)
+
+    return layer
+
+
+def read_layer(path):
+    if path.endswith('.graphml'):
+        return ox.load_graphml(path)
+
+    return gpd.read_parquet(path)
+
+
+def write_layer(layer, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first so readers never see a partial layer. Its
+    # name is unique, as threads loading the same layer share a process id
+    temporary_path = path + '.' + uuid.uuid4().hex + '.tmp'
+    if path.endswith('.graphml'):
+        ox.save_graphml(layer, temporary_path)
+    else:
+        to_columnar(layer).to_parquet(temporary_path)
+    os.replace(temporary_path, path)
+
+
+# OSM features have free-form tag columns that can mix strings with other
+# values, which parquet cannot store in one column
+def to_columnar(layer):
+    layer = layer.copy()
+    for column in layer.columns:
+        if column != layer.geometry.name and layer[column].dtype == object:
+            layer[column] = layer[column].map(lambda value: value if value is None or isinstance(value, str) else str(value))
+
+    return layer
+
+
+# Pre-populate the cache from a local file, e.g. an OSM extract saved as
+# GraphML/OSM XML for roads, or a shapefile/GeoPackage for stops and census
+def import_layer(source, bounds, file_path):
+    from plot_nodes import prepare_census_data
+
+    if source == 'roads':
+        if file_path.endswith('.graphml'):
+            layer = ox.load_graphml(file_path)
+        else:
+            layer = ox.graph_from_xml(file_path)
+        layer = ox.truncate.truncate_graph_bbox(layer, bounds['north'], bounds['south'], bounds['east'], bounds['west'])
+    else:
+        # Given with a CRS, so files in other projections (e.g. NZTM) are clipped correctly
+        bbox = gpd.GeoSeries([box(bounds['west'], bounds['south'], bounds['east'], bounds['north'])], crs='EPSG:4326')
+        layer = gpd.read_file(file_path, bbox=bbox).to_crs(epsg=4326)
+        if source == 'census':
+            layer = prepare_census_data(layer)
+
+    write_layer(layer, cache_path(source, bounds))
+
+    return layer
+
+
+def refresh_layer(source, bounds):
+    from plot_nodes import download_road_network, download_bus_stop_features, download_census_data
+
+    download = {
+        'roads': download_road_network,
+        'stops': download_bus_stop_features,
+        'census': download_census_data,
+    }[source]
+
+    return load_layer(source, bounds, download, refresh=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local data store')
+    parser.add_argument('command', choices=['import', 'refresh', 'list', 'clear'])
+    parser.add_argument('source', nargs='?', choices=SOURCES)
+    parser.add_argument('file', nargs='?', help='Local file to import')
+    parser.add_argument('--bbox', nargs=4, type=float, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'))
+    args = parser.parse_args()
+
+    if args.command in ('import', 'refresh'):
+        if args.source is None or args.bbox is None:
+            parser.error(args.command + ' needs a source and --bbox')
+        bounds = dict(zip(('west', 'south', 'east', 'north'), args.bbox))
+
+        if args.command == 'import':
+            if args.file is None:
+                parser.error('import needs a file')
+            import_layer(args.source, bounds, args.file)
+        else:
+            refresh_layer(args.source, bounds)
+
+    elif args.command == 'list':
+        if os.path.isdir(CACHE_DIR):
+            for name in sorted(os.listdir(CACHE_DIR)):
+                path = os.path.join(CACHE_DIR, name)
+                age = (time.time() - os.path.getmtime(path)) / 3600
+                print(name + ', ' + str(round(age, 1)) + ' hours old' + ('' if is_fresh(path) else ' (stale)'))
+
+    elif args.command == 'clear':
+        if os.path.isdir(CACHE_DIR):
+            for name in os.listdir(CACHE_DIR):
+                if args.source is None or name.startswith(args.source + '_'):
+                    os.remove(os.path.join(CACHE_DIR, name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Graphs the engines run on, built from the data store layers, and the graph
+# nodes for the start and end stop of each route. Shared by the Flask app and
+# batch_planner.py
+import geopandas as gpd
+import networkx as nx
+
+import aco
+import aco_numpy
+import commute_info
+import contraction
+import metrics
+from plot_nodes import plot_census_stops, plot_census_intersections, plot_area, snap_coordinates, get_node
+
+
+MODES = ('bus_stops', 'intersections')
+
+
+# Returns the graph the stops are snapped to and the graph the engine runs
+# on: CSR arrays for the numpy engine, a networkx graph for the python engine.
+# With demand ('demand' or 'both') the heuristic's population is replaced by
+# or averaged with the commuter demand (see commute_info.demand_population).
+# With contract (a tolerance in metres) the road graph is contracted first
+# (see contraction.contract_road_graph), keeping the street polylines in
+# G.graph['edge_geometry'] to expand the paths with. The layers are loaded
+# for region (see regions.py), the default region if None
+def build_graph(
+    mode, stops, engine='numpy', graph_mode='knn', neighbours=8, radius=None, refresh=False, demand=None,
+    contract=None, region=None
+):
+    if (mode == 'bus_stops'):
+        print('Adding population data')
+        graph = plot_census_stops(stops, refresh, region)
+
+        if demand is not None:
+            print('Adding commuter demand')
+            with metrics.timer('demand'):
+                graph = graph.copy()
+                points = graph.geometry.representative_point()
+                graph['sum_population'] = commute_info.demand_population(
+                    graph['sum_population'], commute_info.point_demand(points, region, refresh), demand
+                )
+
+        print('Adding edges')
+        with metrics.timer('edges'):
+            G = aco.create_graph_with_distances(graph, graph_mode, neighbours, radius)
+    elif (mode == 'intersections'):
+        print('Plotting roads')
+        roads = plot_area(refresh, region)
+
+        print('Adding population data')
+        graph = plot_census_intersections(roads, refresh, region)
+
+        if demand is not None:
+            print('Adding commuter demand')
+            with metrics.timer('demand'):
+                nodes = list(graph.nodes())
+                points = gpd.points_from_xy(
+                    [graph.nodes[node]['x'] for node in nodes], [graph.nodes[node]['y'] for node in nodes]
+                )
+                population = [graph.nodes[node].get('sum_population', float('nan')) for node in nodes]
+                population = commute_info.demand_population(
+                    population, commute_info.point_demand(points, region, refresh), demand
+                )
+                nx.set_node_attributes(graph, dict(zip(nodes, population.tolist())), 'sum_population')
+
+        if contract is not None:
+            print('Contracting roads')
+            with metrics.timer('contraction'):
+                before = graph.number_of_nodes()
+                graph = contraction.contract_road_graph(graph, contract)
+            print('Contracted ' + str(before) + ' nodes to ' + str(graph.number_of_nodes()))
+
+        # The numpy engine runs on compact CSR arrays built straight from the
+        # road graph, the python engine on an nx.Graph weighted by road length
+        print('Adding edges')
+        with metrics.timer('edges'):
+            if (engine != 'python'):
+                G = aco_numpy.road_graph_to_arrays(graph)
+                if 'edge_geometry' in graph.graph:
+                    G.graph['edge_geometry'] = graph.graph['edge_geometry']
+            else:
+                G = nx.Graph(graph)
+                nx.set_edge_attributes(G, nx.get_edge_attributes(G, 'length'), 'weight')
+    else:
+        raise ValueError('No mode')
+
+    # Convert once so every route shares the same arrays
+    if (engine != 'python' and not isinstance(G, aco_numpy.GraphArrays)):
+        with metrics.timer('graph_arrays'):
+            G = aco_numpy.graph_to_arrays(G)
+
+    return graph, G
+
+
+# (source, destination) graph nodes for each (start, end) stop ref, None
+# where a stop is not in the graph
+def route_nodes(mode, graph, G, stop_coords, pairs, snap_distance=None):
+    start_nodes = [start for start, _ in pairs]
+    end_nodes = [end for _, end in pairs]
+
+    if(mode == 'bus_stops'):
+        source_nodes = [get_node(G, start_value) for start_value in start_nodes]
+        destination_nodes = [get_node(G, end_value) for end_value in end_nodes]
+    elif(mode == 'intersections'):
+        # Snap all start and end stops to road nodes in one query, skipping
+        # unknown stops
+        coordinates = [stop_coords.get(str(value)) for value in start_nodes + end_nodes]
+        known = [i for i, coordinate in enumerate(coordinates) if coordinate is not None]
+        snapped = [None] * len(coordinates)
+        with metrics.timer('snap'):
+            nodes = snap_coordinates(graph, [coordinates[i] for i in known], snap_distance)
+        for i, node in zip(known, nodes):
+            snapped[i] = node
+
+        source_nodes = snapped[:len(start_nodes)]
+        destination_nodes = snapped[len(start_nodes):]
+
+    return list(zip(source_nodes, destination_nodes))
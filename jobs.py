@@ -0,0 +1,130 @@
+# Background jobs for long optimisation runs. Jobs run on a bounded thread
+# pool with a bounded queue, and keep a short history of progress events that
+# clients can follow with Server-Sent Events
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, max_events=2000):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+        # Latest progress reported by the job, e.g. per route
+        self.progress = {}
+
+        self.cancel_event = threading.Event()
+        self.future = None
+
+        # Events are numbered so a reconnecting client can resume after the last one it saw
+        self.events = deque(maxlen=max_events)
+        self.event_count = 0
+        self.changed = threading.Condition()
+
+    def report(self, event_type, data):
+        with self.changed:
+            self.event_count += 1
+            self.events.append((self.event_count, event_type, data))
+            self.changed.notify_all()
+
+    # Events after last_id, waiting up to timeout for new ones
+    def events_after(self, last_id, timeout=None):
+        with self.changed:
+            if self.event_count <= last_id and not self.done():
+                self.changed.wait(timeout)
+            return [event for event in self.events if event[0] > last_id]
+
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+            'error': self.error,
+            'progress': dict(self.progress),
+        }
+
+
+class JobManager:
+    def __init__(self, workers=2, max_queued=8, max_finished=100):
+        self.executor = ThreadPoolExecutor(workers)
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Run function(job, *args) in the background and return the job straight away
+    def submit(self, function, *args):
+        with self.lock:
+            active = sum(1 for job in self.jobs.values() if not job.done())
+            if active >= self.workers + self.max_queued:
+                raise QueueFullError('Too many jobs queued, try again later')
+
+            job = Job()
+            self.jobs[job.id] = job
+            self.forget_finished()
+
+        job.future = self.executor.submit(self.run, job, function, *args)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+
+        job.cancel_event.set()
+
+        # Jobs that have not started yet are cancelled straight away
+        if job.future is not None and job.future.cancel():
+            self.finish(job, 'cancelled')
+
+        return job
+
+    def run(self, job, function, *args):
+        if job.cancel_event.is_set():
+            self.finish(job, 'cancelled')
+            return
+
+        job.status = 'running'
+        job.started = time.time()
+        job.report('status', job.summary())
+
+        try:
+            job.result = function(job, *args)
+        except Exception as error:
+            job.error = str(error)
+            self.finish(job, 'failed')
+        else:
+            self.finish(job, 'cancelled' if job.cancel_event.is_set() else 'done')
+
+    def finish(self, job, status):
+        job.status = status
+        job.finished = time.time()
+        job.report('status', job.summary())
+
+    # Keep only the most recent finished jobs
+    def forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
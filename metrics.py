@@ -0,0 +1,149 @@
+# Lightweight phase timers and counters, exposed in the Prometheus text format
+# by the /metrics endpoint and per request in a Server-Timing header.
+# Set ACO_METRICS=0 to turn them off, timers then cost a single flag check.
+# With ACO_PROFILING=1 a request can also be profiled with cProfile
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+
+ENABLED = os.environ.get('ACO_METRICS', '1') != '0'
+PROFILING = os.environ.get('ACO_PROFILING', '0') == '1'
+PROFILE_DIR = os.environ.get('ACO_PROFILE_DIR', os.path.join('data', 'profiles'))
+
+# Phases range from milliseconds (snapping) to minutes (downloads, long ACO runs)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Engine stats (see aco.count) reported as counters
+COUNTERS = {
+    'ants': 'Ants constructed',
+    'iterations': 'ACO iterations completed',
+    'ant_steps': 'Edges traversed by ants',
+    'failed_ants': 'Ant walks that hit a dead end without reaching the destination',
+    'restarts': 'Pheromone reinitialisations on stagnation',
+    'warm_starts': 'Routes started from stored pheromone',
+    'routes': 'Routes solved',
+    'cached_routes': 'Routes served from the route cache',
+}
+
+lock = threading.Lock()
+
+# phase -> [bucket counts, sum, count]
+histograms = {}
+counters = dict.fromkeys(COUNTERS, 0)
+
+# Timings of the request being handled by this thread, for Server-Timing
+request_state = threading.local()
+
+
+def observe(phase, seconds):
+    if not ENABLED:
+        return
+
+    with lock:
+        histogram = histograms.get(phase)
+        if histogram is None:
+            histogram = histograms[phase] = [[0] * len(BUCKETS), 0.0, 0]
+        bucket = bisect_left(BUCKETS, seconds)
+        if bucket < len(BUCKETS):
+            histogram[0][bucket] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    timings = getattr(request_state, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def _timer(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - start)
+
+def timer(phase):
+    return _timer(phase) if ENABLED else nullcontext()
+
+
+# Add engine stats to the counters, ignoring anything that is not a counter
+def count(stats):
+    if not ENABLED or not stats:
+        return
+
+    with lock:
+        for name, amount in stats.items():
+            if name in counters:
+                counters[name] += amount
+
+
+def start_request():
+    request_state.timings = {} if ENABLED else None
+
+def finish_request():
+    timings = getattr(request_state, 'timings', None)
+    request_state.timings = None
+    return timings or {}
+
+def server_timing(timings):
+    return ', '.join(phase + ';dur=' + str(round(seconds * 1000, 1)) for phase, seconds in timings.items())
+
+
+def exposition():
+    lines = [
+        '# HELP aco_phase_seconds Time spent in each phase of building and solving routes',
+        '# TYPE aco_phase_seconds histogram',
+    ]
+
+    with lock:
+        for phase, (buckets, total, number) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, amount in zip(BUCKETS, buckets):
+                cumulative += amount
+                lines.append('aco_phase_seconds_bucket{phase="' + phase + '",le="' + str(bound) + '"} ' + str(cumulative))
+            lines.append('aco_phase_seconds_bucket{phase="' + phase + '",le="+Inf"} ' + str(number))
+            lines.append('aco_phase_seconds_sum{phase="' + phase + '"} ' + repr(total))
+            lines.append('aco_phase_seconds_count{phase="' + phase + '"} ' + str(number))
+
+        for name, description in COUNTERS.items():
+            lines.append('# HELP aco_' + name + '_total ' + description)
+            lines.append('# TYPE aco_' + name + '_total counter')
+            lines.append('aco_' + name + '_total ' + str(counters[name]))
+
+    return '\n'.join(lines) + '\n'
+
+
+# cProfile capture, written to PROFILE_DIR/<name>.prof for snakeviz or pstats
+def start_profile():
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Only one profiler can be active at a time on Python 3.12+
+        print('Another profile is running, not profiling')
+        return None
+    return profiler
+
+def save_profile(profiler, name):
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name + '.prof')
+    profiler.dump_stats(path)
+    return path
+
+@contextmanager
+def profile(name, enabled=True):
+    if not (enabled and PROFILING):
+        yield
+        return
+
+    profiler = start_profile()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            print('Profile written to ' + save_profile(profiler, name))
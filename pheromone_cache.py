@@ -0,0 +1,136 @@
+# Pheromone kept between runs, so a route solved again (e.g. with more ants
+# or iterations) carries on from what the last run learned instead of
+# starting from uniform trails. Levels are stored per (graph fingerprint,
+# source, destination, parameters) as float32 .npy files, read memory-mapped,
+# and evicted by age and by the total size of the store
+import hashlib
+import os
+import time
+import uuid
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+
+PHEROMONE_DIR = os.environ.get('ACO_PHEROMONE_DIR', os.path.join('data', 'pheromone'))
+
+# Stored pheromone older than this (in seconds) is evicted
+PHEROMONE_TTL = float(os.environ.get('ACO_PHEROMONE_TTL', 7 * 24 * 3600))
+
+# Least recently used files are evicted once the store is larger than this (in bytes)
+PHEROMONE_MAX_BYTES = int(os.environ.get('ACO_PHEROMONE_MAX_BYTES', 512 * 1024 ** 2))
+
+# 'stored' starts from the stored levels if there are any, uniform trails
+# otherwise, 'shortest' from trails seeded along the shortest path instead
+WARM_STARTS = ('stored', 'shortest')
+
+# Level of the edges on the shortest path when seeding, relative to the others
+SEED_LEVEL = 10.0
+
+
+# Parameters that change the scale or meaning of the levels are part of the
+# key, the number of ants and iterations are not
+def pheromone_key(arrays, source, destination, **parameters):
+    key = repr((arrays.fingerprint, source, destination, sorted(parameters.items())))
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def pheromone_path(key):
+    return os.path.join(PHEROMONE_DIR, key + '.npy')
+
+
+def load_pheromone(key, num_edges):
+    path = pheromone_path(key)
+    try:
+        stored = np.load(path, mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if stored.shape != (num_edges,):
+        return None
+
+    # Mark as recently used for eviction
+    os.utime(path)
+
+    return np.array(stored, dtype=np.float64)
+
+
+def save_pheromone(key, pheromone):
+    os.makedirs(PHEROMONE_DIR, exist_ok=True)
+    path = pheromone_path(key)
+
+    # Write to a temporary file first so readers never see partial levels. Its
+    # name is unique, as threads of one process can save the same key
+    temporary_path = path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        np.save(file, pheromone.astype(np.float32))
+    os.replace(temporary_path, path)
+
+    evict()
+
+
+def evict(max_bytes=None, max_age=None):
+    max_bytes = PHEROMONE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age = PHEROMONE_TTL if max_age is None else max_age
+    if not os.path.isdir(PHEROMONE_DIR):
+        return
+
+    files = []
+    for name in os.listdir(PHEROMONE_DIR):
+        if name.endswith('.npy'):
+            path = os.path.join(PHEROMONE_DIR, name)
+            try:
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except FileNotFoundError:
+                continue
+
+    # Oldest first, removing expired files and then the least recently used
+    # until the store fits
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    now = time.time()
+    for modified, size, path in files:
+        if now - modified <= max_age and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+# Uniform trails with the edges on the shortest path raised to level
+def shortest_path_pheromone(arrays, source, destination, level=SEED_LEVEL):
+    pheromone = np.ones(arrays.num_edges)
+
+    matrix = csr_matrix(
+        (arrays.weights.astype(np.float64), arrays.indices, arrays.indptr), shape=(arrays.num_nodes,) * 2
+    )
+    _, predecessors = dijkstra(matrix, directed=False, indices=source, return_predecessors=True)
+
+    node = destination
+    while predecessors[node] >= 0:
+        previous = predecessors[node]
+        entries = np.arange(arrays.indptr[previous], arrays.indptr[previous + 1])
+        # Entries are sorted by weight, so the first match is the shortest edge
+        entry = entries[arrays.indices[entries] == node][0]
+        pheromone[arrays.edge_ids[entry]] = level
+        node = previous
+
+    return pheromone
+
+
+# Starting levels for a route, and whether they were loaded from the store
+def starting_pheromone(arrays, key, source, destination, warm_start):
+    if warm_start not in WARM_STARTS:
+        raise ValueError('Unknown warm start: ' + str(warm_start) + ', use one of ' + ', '.join(WARM_STARTS))
+
+    pheromone = load_pheromone(key, arrays.num_edges)
+    if pheromone is not None:
+        return pheromone, True
+
+    if warm_start == 'shortest':
+        return shortest_path_pheromone(arrays, arrays.index[source], arrays.index[destination]), False
+
+    return np.ones(arrays.num_edges), False
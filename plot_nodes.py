@@ -1,17 +1,24 @@
 # Importing GIS libraries
 import osmnx as ox
 import geopandas as gpd
+import pandas as pd
 from requests import Request
 from owslib.wfs import WebFeatureService
 
-from shapely.geometry import Point
 import networkx as nx
+import numpy as np
+from scipy.spatial import cKDTree
+
+import data_store
+import metrics
+import regions
+from aco_numpy import GraphArrays
 
 
 # Download OSM road network for area
-def download_road_network(bounds):
+def download_road_network(bounds, **options):
     G = ox.graph_from_bbox(
-        bounds['north'], bounds['south'], bounds['east'], bounds['west'], network_type='drive'
+        bounds['north'], bounds['south'], bounds['east'], bounds['west'], network_type='drive', **options
     )
 
     return G
@@ -43,7 +50,8 @@ def download_bus_stop_features(bounds):
             "not:network:wikidata",
         ],
         inplace=True,
-    )  # Many empty fields
+        errors="ignore",
+    )  # Many empty fields, not all of which are in every tile
 
     # Bus stops taken from BOPRC API, OSM is similar enough and can be applied to anywhere
     # bus_stop_features = gpd.read_file('https://gis.boprc.govt.nz/server2/rest/services/BayOfPlentyMaps/Community/MapServer/3/query?where=1%3D1&outFields=BusStopName,BusStopID,ZoneID,StopLatitude,StopLongitude&outSR=4326&f=json') # They scrape from Google Maps?
@@ -51,9 +59,31 @@ def download_bus_stop_features(bounds):
     return bus_stop_features
 
 
-# Read in population meshblock data,
-# removing unnecessary data, and combining General and Māori electorate populations
-def read_census_data(bbox):
+# Tiles of a larger region can hold no roads or stops at all (open sea, say),
+# these are cached as empty layers instead of failing. Tile roads are kept
+# unsimplified, whole and with the edges crossing the tile's edges, since
+# osmnx simplifies before truncating: a long simplified street crossing a
+# seam would otherwise be in neither tile. plot_area simplifies once stitched
+def download_tile_roads(bounds):
+    try:
+        return download_road_network(bounds, simplify=False, retain_all=True, truncate_by_edge=True)
+    except (ValueError, ox._errors.InsufficientResponseError):
+        return nx.MultiDiGraph(crs='epsg:4326')
+
+def download_tile_stops(bounds):
+    try:
+        return download_bus_stop_features(bounds)
+    except ox._errors.InsufficientResponseError:
+        return gpd.GeoDataFrame(geometry=[], crs='EPSG:4326')
+
+
+# Read in population meshblock data from the local store, downloading it if needed
+def read_census_data(bbox, refresh=False):
+    return data_store.load_layer('census', bbox, download_census_data, refresh)
+
+
+# Download population meshblock data
+def download_census_data(bbox):
     # URL for WFS backend
     url = "https://datafinder.stats.govt.nz/services;key=1f0a305f72954361a9b5a7aa6750f2db/wfs"
 
@@ -83,10 +113,20 @@ def read_census_data(bbox):
     # census_data = gpd.read_file(shapefile_path, bbox=bbox)
     # census_data = census_data.to_crs(epsg=4326)  # Convert to standard coordinate reference system for easier manipulation
 
+    return prepare_census_data(census_data)
+
+
+# Remove unnecessary data, and combine General and Māori electorate populations
+def prepare_census_data(census_data):
+    # Shape files abbreviate the column names
+    census_data = census_data.rename(
+        columns={"General_El": "General_Electoral_Population", "Maori_Elec": "Maori_Electoral_Population"}
+    )
+
     # Remove unneeded data
     census_data = census_data[
         ["General_Electoral_Population", "Maori_Electoral_Population", "geometry"]
-    ]
+    ].copy()
 
     census_data["sum_population"] = census_data["General_Electoral_Population"].replace(
         -999, 0
@@ -100,122 +140,199 @@ def read_census_data(bbox):
     return census_data
 
 
+# Population of the meshblock containing each geometry (NaN outside every
+# meshblock), found with one bulk query against the census spatial index
+def population_within(geometries, census_data):
+    geometries = gpd.GeoSeries(geometries).reset_index(drop=True)
+    population = np.full(len(geometries), np.nan)
+
+    geometry_ids, meshblock_ids = census_data.sindex.query(geometries, predicate='within')
+
+    # A geometry on a shared boundary may match several meshblocks, keep the first
+    geometry_ids, first = np.unique(geometry_ids, return_index=True)
+    population[geometry_ids] = census_data['sum_population'].to_numpy(dtype=float)[meshblock_ids[first]]
+
+    return population
+
+# Population of the meshblock containing each geometry, placed at xs, ys.
+# census_data is a meshblock layer, or a Region whose meshblocks are read one
+# tile at a time and joined to the geometries in that tile
+def census_population(geometries, xs, ys, census_data, refresh=False):
+    if not isinstance(census_data, regions.Region):
+        with metrics.timer('spatial_join'):
+            return population_within(geometries, census_data)
+
+    geometries = gpd.GeoSeries(geometries).reset_index(drop=True)
+    population = np.full(len(geometries), np.nan)
+    for tile in census_data.tiles():
+        inside = np.flatnonzero(regions.within(tile, xs, ys))
+        if not inside.size:
+            continue
+
+        meshblocks = read_census_data(tile, refresh)
+        with metrics.timer('spatial_join'):
+            population[inside] = population_within(geometries.iloc[inside], meshblocks)
+
+    return population
+
 # Spatially join population data to bus stops within meshblock
-def process_data_stops(bus_stop_features, census_data):
-    joined_data = gpd.sjoin(
-        bus_stop_features, census_data, how="left", predicate="within"
+def process_data_stops(bus_stop_features, census_data, refresh=False):
+    joined_data = bus_stop_features.copy()
+    points = bus_stop_features.geometry.representative_point()
+    joined_data['sum_population'] = census_population(
+        bus_stop_features.geometry, points.x.to_numpy(), points.y.to_numpy(), census_data, refresh
     )
     return joined_data
 
-def process_data_intersections(roads, census_data):
+def process_data_intersections(roads, census_data, refresh=False):
     none_nodes = [node for node in roads.nodes() if node is None]
     roads.remove_nodes_from(none_nodes)
 
-    pos = {node: (data['x'], data['y']) for node, data in roads.nodes(data=True)}
+    nodes = list(roads.nodes())
+    xs = np.array([roads.nodes[node]['x'] for node in nodes], dtype=float)
+    ys = np.array([roads.nodes[node]['y'] for node in nodes], dtype=float)
+
+    pos = dict(zip(nodes, zip(xs.tolist(), ys.tolist())))
     nx.set_node_attributes(roads, pos, 'pos')
 
     print('adding census population')
-    for node_id, data in roads.nodes(data=True):
-        point = Point(data.get('pos'))
-        
-        # Check if the point falls within any polygon
-        intersected_polygon = census_data[census_data.geometry.contains(point)]
-        
-        if not intersected_polygon.empty:
-            # Update existing node attributes with the joined information
-            roads.nodes[node_id].update(intersected_polygon.iloc[0].to_dict())
+    population = census_population(gpd.points_from_xy(xs, ys, crs='EPSG:4326'), xs, ys, census_data, refresh)
 
+    # Only nodes inside a meshblock get a population, the rest keep the default
+    sum_population = pd.Series(population, index=nodes).dropna()
+    nx.set_node_attributes(roads, sum_population.to_dict(), 'sum_population')
+    roads.graph['sum_population'] = sum_population
 
     return roads
 
 
-def plot_area():
-    tauranga_bounds = {
-        "north": -37.6039,
-        "east": 176.5125,
-        "south": -37.8114,
-        "west": 176.0593,
-    }
+# Road network of the region. A tiled region's roads are read a tile at a
+# time and stitched, keeping only what the graphs use of each tile, then
+# clipped to the region and simplified once
+def plot_area(refresh=False, region=None):
+    region = region or regions.default_region()
+    tiles = region.tiles()
+
+    if len(tiles) == 1:
+        road_graph = data_store.load_layer('roads', tiles[0], download_road_network, refresh)
+        return clip_roads(road_graph, region)
+
+    road_graph = nx.MultiDiGraph(crs='epsg:4326')
+    for i, tile in enumerate(tiles):
+        print('Loading roads for tile ' + str(i + 1) + ' of ' + str(len(tiles)))
+        tile_roads = data_store.load_layer('roads', region.with_margin(tile), download_tile_roads, refresh)
+        stitch_roads(road_graph, tile_roads)
+
+    road_graph = clip_roads(road_graph, region, largest_only=False)
+    with metrics.timer('simplify'):
+        road_graph = ox.simplify_graph(road_graph)
+
+    return largest_component(road_graph)
+
+# Add a tile's roads to the stitched graph with their positions and lengths.
+# Nodes and edges are keyed by OSM id, so roads in the overlap of two tiles
+# are only added once
+def stitch_roads(roads, tile_roads):
+    for node, data in tile_roads.nodes(data=True):
+        roads.add_node(node, x=data['x'], y=data['y'])
+
+    for u, v, key, data in tile_roads.edges(keys=True, data=True):
+        roads.add_edge(u, v, key, length=data['length'])
+
+# Remove the nodes outside the region (the tiles' margins, or outside its
+# polygon), then by default keep the largest connected part like osmnx does
+def clip_roads(roads, region, largest_only=True):
+    nodes = list(roads.nodes())
+    xs = [roads.nodes[node]['x'] for node in nodes]
+    ys = [roads.nodes[node]['y'] for node in nodes]
+    inside = region.contains(xs, ys)
+    roads.remove_nodes_from([node for node, keep in zip(nodes, inside.tolist()) if not keep])
+
+    return largest_component(roads) if largest_only else roads
+
+# Keep the largest weakly connected part of the roads, saying how much was left out
+def largest_component(roads):
+    if not roads.number_of_nodes():
+        return roads
+
+    largest = max(nx.weakly_connected_components(roads), key=len)
+    dropped = roads.number_of_nodes() - len(largest)
+    if dropped:
+        print('Dropped ' + str(dropped) + ' road nodes not connected to the main network')
+        roads.remove_nodes_from([node for node in list(roads.nodes()) if node not in largest])
 
-    road_graph = download_road_network(tauranga_bounds)
+    return roads
+
+# Create geodataframe with bus stops in the region, read a tile at a time
+def plot_stops(refresh=False, region=None):
+    region = region or regions.default_region()
+    tiles = region.tiles()
 
-    return road_graph
+    if len(tiles) == 1:
+        bus_stop_features = data_store.load_layer('stops', tiles[0], download_bus_stop_features, refresh)
+    else:
+        layers = [data_store.load_layer('stops', tile, download_tile_stops, refresh) for tile in tiles]
+        bus_stop_features = gpd.GeoDataFrame(pd.concat(layers), crs='EPSG:4326')
 
-# Create geodataframe with bus stops/population data
-def plot_stops():
-    # TODO: Remove hard coded values
-    # Define map boundaries for Tauranga, New Zealand
-    tauranga_bounds = {
-        "north": -37.6039,
-        "east": 176.5125,
-        "south": -37.8114,
-        "west": 176.0593,
-    }
+        # Stops on the edge between two tiles are in both
+        bus_stop_features = bus_stop_features[~bus_stop_features.index.duplicated()]
 
-    bus_stop_features = download_bus_stop_features(tauranga_bounds)
+    if region.polygon is not None:
+        points = bus_stop_features.geometry.representative_point()
+        bus_stop_features = bus_stop_features[region.contains(points.x, points.y)]
 
     return bus_stop_features
 
-def plot_census_stops(stops):
-    # TODO: Remove hard coded values
-    # Define map boundaries for Tauranga, New Zealand
-    tauranga_bounds = {
-        "north": -37.6039,
-        "east": 176.5125,
-        "south": -37.8114,
-        "west": 176.0593,
-    }
+# Join census population to the stops, one tile of meshblocks at a time
+def plot_census_stops(stops, refresh=False, region=None):
+    return process_data_stops(stops, region or regions.default_region(), refresh)
 
-    # Read census data shapefile within the same boundaries
-    census_data = read_census_data(tauranga_bounds)
+# Join census population to the road nodes, one tile of meshblocks at a time
+def plot_census_intersections(roads, refresh=False, region=None):
+    return process_data_intersections(roads, region or regions.default_region(), refresh)
 
-    # Process and join data
-    joined_data = process_data_stops(stops, census_data)
 
-    # Calculate the mean of the summed population in the joined data
-    # (may be used in future data)
-    #mean_pop = joined_data["sum_population"].mean()
+# KD-tree over the node positions of a graph (networkx or GraphArrays), built
+# once and reused for every coordinate lookup against that graph
+class NodeIndex:
+    def __init__(self, graph):
+        if isinstance(graph, GraphArrays):
+            self.nodes = np.asarray(graph.nodes).tolist()
+            self.coords = np.asarray(graph.coords, dtype=float)
+        else:
+            self.nodes = list(graph.nodes())
+            self.coords = np.array([data['pos'][:2] for _, data in graph.nodes(data=True)], dtype=float).reshape(-1, 2)
+        self.size = len(self.nodes)
+        self.tree = cKDTree(self.coords)
 
-    # Create an interactive map and save it as an HTML file
-    return joined_data
+    # Nearest node to each (longitude, latitude), None where the nearest
+    # node is further away than max_distance
+    def nearest(self, coordinates, max_distance=None):
+        coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+        if not self.size:
+            return [None] * len(coordinates)
 
-def plot_census_intersections(roads):
-    # TODO: Remove hard coded values
-    # Define map boundaries for Tauranga, New Zealand
-    tauranga_bounds = {
-        "north": -37.6039,
-        "east": 176.5125,
-        "south": -37.8114,
-        "west": 176.0593,
-    }
+        distance_bound = np.inf if max_distance is None else max_distance
+        distances, positions = self.tree.query(coordinates, distance_upper_bound=distance_bound)
 
-    # Read census data shapefile within the same boundaries
-    census_data = read_census_data(tauranga_bounds)
+        return [self.nodes[i] if np.isfinite(d) else None for d, i in zip(distances, positions)]
 
-    # Process and join data
-    joined_data = process_data_intersections(roads, census_data)
 
-    # Calculate the mean of the summed population in the joined data
-    # (may be used in future data)
-    #mean_pop = joined_data["sum_population"].mean()
+# Index stored on the graph, rebuilt if nodes have been added or removed since
+def get_node_index(graph):
+    index = graph.graph.get('node_index')
+    if index is None or index.size != len(graph.nodes):
+        index = NodeIndex(graph)
+        graph.graph['node_index'] = index
 
-    # Create an interactive map and save it as an HTML file
-    return joined_data
+    return index
 
+# Snap a list of coordinates to their nearest graph nodes in one query
+def snap_coordinates(graph, coordinates, max_distance=None):
+    return get_node_index(graph).nearest(coordinates, max_distance)
 
 def find_node(graph, target_coordinates):
-    min_distance = float('inf')
-    closest_node = None
- 
-    for node, data in graph.nodes(data=True):
-        node_coordinates = data['pos']
-        distance = ((node_coordinates[0] - target_coordinates[0])**2 + (node_coordinates[1] - target_coordinates[1])**2)**0.5
- 
-        if distance < min_distance:
-            min_distance = distance
-            closest_node = node
- 
-    return closest_node
+    return snap_coordinates(graph, [target_coordinates])[0]
 
 def get_node(graph, target_node):
     if target_node in graph.nodes:
@@ -223,14 +340,19 @@ def get_node(graph, target_node):
     else:
         print(target_node + "not found")
 
-def get_coords(gdf, id):
-    node = gdf[gdf['ref'] == str(id)]
+# Map each stop ref to its (longitude, latitude). Later stops win for
+# duplicated refs, as in aco.create_graph_with_distances, so a ref is the
+# same stop in both modes
+def stop_coordinates(gdf):
+    stops = gdf[gdf['ref'].notna()]
+    stops = stops[~stops['ref'].astype(str).duplicated(keep='last')]
+    points = stops.geometry.representative_point()
+
+    return dict(zip(stops['ref'].astype(str), zip(points.x.tolist(), points.y.tolist())))
 
-    coordinates = node.geometry.iloc[0].coords[0]
-    
-    # Format the coordinates as (longitude, latitude)
-    lon, lat = coordinates
-    return((lon, lat))
+def get_coords(stop_coords, id):
+    # Coordinates are formatted as (longitude, latitude)
+    return stop_coords[str(id)]
 
 
 
@@ -0,0 +1,152 @@
+# Areas the layers are loaded for. A Region is a bounding box, or a polygon
+# within one, split into square tiles of tile_size degrees. plot_nodes reads
+# each tile's roads, stops and census meshblocks from the data store on their
+# own (cached per tile, see data_store.cache_path) and stitches them into one
+# graph, so only one tile of raw layers is in memory at a time. The default
+# region is Tauranga, or ACO_REGION: a 'west,south,east,north' bbox or a file
+# with the area's polygon (anything geopandas reads)
+import math
+import os
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import box
+
+
+# Tile edge in degrees, 0 loads the region in one piece
+TILE_SIZE = float(os.environ.get('ACO_TILE_SIZE', 0))
+
+# Roads are fetched this many degrees beyond each tile's edges, so streets
+# crossing an edge are whole in at least one tile
+TILE_MARGIN = float(os.environ.get('ACO_TILE_MARGIN', 0.005))
+
+
+class Region:
+    def __init__(self, bounds, polygon=None, name=None, tile_size=None):
+        self.bounds = dict(bounds)
+        self.polygon = polygon
+        self.name = name
+        self.tile_size = TILE_SIZE if tile_size is None else tile_size
+
+    @classmethod
+    def from_bbox(cls, west, south, east, north, name=None, tile_size=None):
+        if west >= east or south >= north:
+            raise ValueError('Empty bounding box: ' + str((west, south, east, north)))
+
+        name = name or 'bbox_{:.4f}_{:.4f}_{:.4f}_{:.4f}'.format(west, south, east, north)
+        return cls(dict(north=north, east=east, south=south, west=west), None, name, tile_size)
+
+    # Polygon in longitude and latitude
+    @classmethod
+    def from_polygon(cls, polygon, name=None, tile_size=None):
+        west, south, east, north = polygon.bounds
+        shapely.prepare(polygon)
+
+        return cls(dict(north=north, east=east, south=south, west=west), polygon, name, tile_size)
+
+    # The union of every shape in a file, in any CRS
+    @classmethod
+    def from_file(cls, path, tile_size=None):
+        shapes = gpd.read_file(path).to_crs(4326)
+        name = os.path.splitext(os.path.basename(path))[0]
+
+        return cls.from_polygon(shapely.union_all(np.asarray(shapes.geometry)), name, tile_size)
+
+    # A bbox as 'west,south,east,north', or a polygon file
+    @classmethod
+    def parse(cls, spec, tile_size=None):
+        if os.path.exists(spec):
+            return cls.from_file(spec, tile_size)
+
+        try:
+            west, south, east, north = (float(value) for value in spec.split(','))
+        except ValueError:
+            raise ValueError('Unknown region: ' + spec + ', use west,south,east,north or a polygon file') from None
+
+        return cls.from_bbox(west, south, east, north, tile_size=tile_size)
+
+    # The area as a GeoSeries, to read layers clipped to it
+    def geoseries(self):
+        shape = self.polygon if self.polygon is not None else box(*self.bbox())
+        return gpd.GeoSeries([shape], crs='EPSG:4326')
+
+    def bbox(self):
+        return self.bounds['west'], self.bounds['south'], self.bounds['east'], self.bounds['north']
+
+    # Bounds of the tiles, row by row from the south-west, skipping tiles
+    # outside the polygon. The whole bounds when the region fits in one tile
+    def tiles(self):
+        west, south, east, north = self.bbox()
+        if self.tile_size <= 0 or (east - west <= self.tile_size and north - south <= self.tile_size):
+            return [dict(self.bounds)]
+
+        xs = np.linspace(west, east, math.ceil((east - west) / self.tile_size) + 1).tolist()
+        ys = np.linspace(south, north, math.ceil((north - south) / self.tile_size) + 1).tolist()
+
+        tiles = []
+        for tile_south, tile_north in zip(ys, ys[1:]):
+            for tile_west, tile_east in zip(xs, xs[1:]):
+                if self.polygon is None or self.polygon.intersects(box(tile_west, tile_south, tile_east, tile_north)):
+                    tiles.append(dict(north=tile_north, east=tile_east, south=tile_south, west=tile_west))
+
+        return tiles
+
+    # Bounds to fetch a tile's roads with, the tile and its margin. A region
+    # in one piece has nothing to stitch, so its tile is fetched as it is
+    def with_margin(self, tile, margin=TILE_MARGIN):
+        if tile == self.bounds:
+            return dict(tile)
+
+        return dict(
+            north=tile['north'] + margin, east=tile['east'] + margin,
+            south=tile['south'] - margin, west=tile['west'] - margin,
+        )
+
+    # Whether each (xs, ys) point is in the region
+    def contains(self, xs, ys):
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        inside = within(self.bounds, xs, ys)
+        if self.polygon is not None:
+            inside &= shapely.intersects_xy(self.polygon, xs, ys)
+
+        return inside
+
+
+# Whether each point is within bounds, edges included, so a point on the edge
+# between two tiles is in both
+def within(bounds, xs, ys):
+    xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    return (
+        (xs >= bounds['west']) & (xs <= bounds['east'])
+        & (ys >= bounds['south']) & (ys <= bounds['north'])
+    )
+
+
+# Map boundaries for Tauranga, New Zealand, the original area
+TAURANGA = Region(
+    {
+        "north": -37.6039,
+        "east": 176.5125,
+        "south": -37.8114,
+        "west": 176.0593,
+    },
+    name='tauranga',
+)
+
+
+@lru_cache(maxsize=None)
+def default_region():
+    spec = os.environ.get('ACO_REGION')
+    return Region.parse(spec) if spec else TAURANGA
+
+
+# Region for the command line options: spec as in Region.parse, or the
+# default region, split into tiles of tile_size degrees if given
+def region_option(spec=None, tile_size=None):
+    region = Region.parse(spec, tile_size) if spec else default_region()
+    if tile_size is not None and tile_size != region.tile_size:
+        region = Region(region.bounds, region.polygon, region.name, tile_size)
+
+    return region
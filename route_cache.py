@@ -0,0 +1,136 @@
+# Solved routes and built graphs kept between requests, so pressing "Run
+# algorithm" again only solves the routes that are new or whose settings
+# changed. Both are bounded LRU caches, and routes evicted from memory can be
+# spilled to disk (ACO_ROUTE_CACHE_DIR) and read back on a later miss
+import hashlib
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+
+# Routes and graphs kept in memory
+MAX_ROUTES = int(os.environ.get('ACO_ROUTE_CACHE_SIZE', 256))
+MAX_GRAPHS = int(os.environ.get('ACO_GRAPH_CACHE_SIZE', 2))
+
+# Directory for routes evicted from memory, no spilling if unset, and the
+# number of spilled routes kept there
+SPILL_DIR = os.environ.get('ACO_ROUTE_CACHE_DIR') or None
+MAX_SPILLED = int(os.environ.get('ACO_ROUTE_CACHE_SPILLED', 10000))
+
+# Settings that change the graph, as opposed to the engine options
+GRAPH_SETTINGS = ('mode', 'graph_mode', 'neighbours', 'radius', 'snap_distance', 'demand', 'contract')
+
+
+class LRUCache:
+    def __init__(self, max_items, spill_dir=None, max_spilled=MAX_SPILLED):
+        self.max_items = max_items
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+
+        value = self.read_spilled(key)
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+
+            evicted = []
+            while len(self.items) > self.max_items:
+                evicted.append(self.items.popitem(last=False))
+
+        for evicted_key, evicted_value in evicted:
+            self.spill(evicted_key, evicted_value)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+    # Keys are hex digests, so they double as file names
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, key + '.pickle')
+
+    def spill(self, key, value):
+        if self.spill_dir is None:
+            return
+
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = self.spill_path(key)
+
+        # Write to a temporary file first so readers never see a partial route.
+        # Its name is unique, as threads of one process can spill the same key
+        temporary_path = path + '.' + uuid.uuid4().hex + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+        self.evict_spilled()
+
+    def read_spilled(self, key):
+        if self.spill_dir is None:
+            return None
+
+        try:
+            with open(self.spill_path(key), 'rb') as file:
+                return pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    # Remove the oldest spilled routes beyond max_spilled
+    def evict_spilled(self):
+        paths = [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir) if name.endswith('.pickle')]
+        if len(paths) <= self.max_spilled:
+            return
+
+        for path in sorted(paths, key=os.path.getmtime)[:len(paths) - self.max_spilled]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+routes = LRUCache(MAX_ROUTES, SPILL_DIR)
+graphs = LRUCache(MAX_GRAPHS)
+
+
+def digest(value):
+    return hashlib.blake2b(repr(value).encode(), digest_size=16).hexdigest()
+
+
+# The graph depends on the data snapshot and the graph settings, and on the
+# engine, which decides between CSR arrays and a networkx graph
+def graph_key(version, settings):
+    return digest((version, [settings[name] for name in GRAPH_SETTINGS], settings['options']['engine'] == 'python'))
+
+# A route's result depends on the graph, its start and end stops and every
+# engine option (num_ants, iterations, seed, strategy, ...)
+def route_key(version, settings, start, end):
+    return digest((graph_key(version, settings), start, end, sorted(settings['options'].items())))
+
+
+# Only complete results are kept: not failed routes, nor routes cut short by
+# a time limit or cancellation. Warm started routes are not kept either, as
+# each run refines the stored pheromone and should be solved again
+def cacheable(result, settings, cancel=None):
+    return (
+        result['error'] is None
+        and settings['time_limit'] is None
+        and not settings['options'].get('warm_start')
+        and (cancel is None or not cancel.is_set())
+    )
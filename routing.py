@@ -0,0 +1,217 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.managers import SyncManager
+from queue import Empty
+
+import aco
+import aco_numpy
+import metrics
+import pheromone_cache
+from contraction import expand_path
+from corridor import corridor_subgraph
+
+
+# Solve one route with the chosen engine. The graph is shared between routes,
+# so each engine computes its origin-specific heuristic per route instead of
+# writing it onto the graph. With corridor ('ellipse', 'buffer' or 'shortest')
+# the ants only search a corridor of the graph around the route (see
+# corridor.corridor_subgraph). With warm_start ('stored' or 'shortest') the
+# numpy engine starts from the pheromone stored by the last run of the route
+# and stores its final pheromone for the next (see pheromone_cache). Paths
+# over a contracted road graph are expanded to the full street polyline
+def solve_route(
+    graph, source, destination, num_ants, iterations, evaporation_rate, engine='numpy', seed=None, workers=1,
+    callback=None, cancel=None, deadline=None, patience=None, min_entropy=None, stats=None,
+    strategy='as', restart_after=None, restart_entropy=None, max_steps=None, candidates=None,
+    corridor=None, slack=1.5, warm_start=None
+):
+    geometry = graph.graph.get('edge_geometry')
+
+    if corridor is not None:
+        start = time.perf_counter()
+        graph = corridor_subgraph(graph, source, destination, corridor, slack)
+        aco.count(stats, corridor_seconds=time.perf_counter() - start, corridor_nodes=len(graph.nodes))
+
+    run_options = dict(
+        callback=callback, cancel=cancel, deadline=deadline, patience=patience, min_entropy=min_entropy, stats=stats,
+        strategy=strategy, restart_after=restart_after, restart_entropy=restart_entropy, max_steps=max_steps,
+        candidates=candidates
+    )
+
+    if engine == 'python':
+        if warm_start is not None:
+            raise ValueError('Warm starts need the numpy engine')
+        path, distance = aco.ant_colony_optimisation(
+            graph, source, destination, num_ants, iterations, evaporation_rate, **run_options
+        )
+    elif warm_start is None:
+        path, distance = aco_numpy.ant_colony_optimisation(
+            graph, source, destination, num_ants, iterations, evaporation_rate, seed=seed, workers=workers, **run_options
+        )
+    else:
+        # Corridor subgraphs have their own fingerprint, so they are stored separately
+        if not isinstance(graph, aco_numpy.GraphArrays):
+            graph = aco_numpy.graph_to_arrays(graph)
+        key = pheromone_cache.pheromone_key(
+            graph, source, destination, strategy=strategy, evaporation_rate=evaporation_rate
+        )
+        pheromone, stored = pheromone_cache.starting_pheromone(graph, key, source, destination, warm_start)
+        aco.count(stats, warm_starts=int(stored))
+
+        path, distance = aco_numpy.ant_colony_optimisation(
+            graph, source, destination, num_ants, iterations, evaporation_rate, seed=seed, workers=workers,
+            pheromone=pheromone, **run_options
+        )
+        pheromone_cache.save_pheromone(key, pheromone)
+
+    return expand_path(path, geometry), distance
+
+
+# Solve every (source, destination) pair, concurrently across processes when
+# processes > 1. Results come back in input order as dicts with the best path
+# and distance, or an error message for a route that failed, without
+# stopping the other routes, plus the engine's stats (see aco.count).
+# progress(route_index, iteration, best_path, best_distance) is called after
+# every iteration of every route, and setting cancel (a threading.Event)
+# stops every route, keeping the best paths found so far
+def solve_routes(graph, routes, options, processes=1, progress=None, cancel=None):
+    if processes > 1 and len(routes) > 1:
+        with ProcessPoolExecutor(min(processes, len(routes)), initializer=set_route_graph, initargs=(graph,)) as executor:
+            if progress is None and cancel is None:
+                futures = [executor.submit(solve_route_task, route, options) for route in routes]
+            else:
+                futures = solve_reporting_routes(executor, routes, options, progress, cancel)
+
+            results = []
+            for (source, destination), future in zip(routes, futures):
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    results.append(route_result(source, destination, error=error))
+    else:
+        # Solved in this process, possibly alongside other threads' requests,
+        # so the graph is passed down rather than set for the process
+        report = None if progress is None else lambda update: progress(*update)
+        results = [
+            solve_route_task(route, options, RouteProgress(index, report), cancel, graph)
+            for index, route in enumerate(routes)
+        ]
+
+    record_metrics(results)
+    return results
+
+
+# Stats come back with each result, so routes solved in worker processes are
+# counted here in the process serving /metrics
+def record_metrics(results):
+    for result in results:
+        stats = result.get('stats')
+        if not stats:
+            continue
+
+        metrics.count(dict(stats, routes=1))
+        if 'origin_distance_seconds' in stats:
+            metrics.observe('origin_distances', stats['origin_distance_seconds'])
+        if 'solve_seconds' in stats:
+            metrics.observe('aco_route', stats['solve_seconds'])
+        if 'corridor_seconds' in stats:
+            metrics.observe('corridor', stats['corridor_seconds'])
+
+
+# Worker processes send their progress through a manager queue, which is
+# drained here and passed on to progress until every route has finished.
+# cancel is relayed to the workers through a manager event
+def solve_reporting_routes(executor, routes, options, progress, cancel):
+    manager = SyncManager()
+    manager.start(aco.ignore_interrupt)
+    with manager:
+        queue = manager.Queue()
+        stop = manager.Event()
+
+        futures = [
+            executor.submit(solve_route_task, route, options, RouteProgress(index, queue.put), stop)
+            for index, route in enumerate(routes)
+        ]
+
+        pending = set(futures)
+        while pending:
+            if cancel is not None and cancel.is_set():
+                stop.set()
+
+            _, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            drain_progress(queue, progress)
+
+        drain_progress(queue, progress)
+
+    return futures
+
+
+def drain_progress(queue, progress):
+    while True:
+        try:
+            update = queue.get_nowait()
+        except Empty:
+            return
+        if progress is not None:
+            progress(*update)
+
+
+# Engine callback for one route, forwarding progress with the route's index
+class RouteProgress:
+    def __init__(self, route_index, report=None):
+        self.route_index = route_index
+        self.report = report
+
+    def __call__(self, iteration, best_path, best_distance):
+        if self.report is not None:
+            self.report((self.route_index, iteration, best_path, best_distance))
+
+
+def route_result(source, destination, path=None, distance=None, error=None, stats=None):
+    if error is not None:
+        print('\nRoute ' + str(source) + ' to ' + str(destination) + ' failed: ' + str(error))
+
+    return {
+        'source': source,
+        'destination': destination,
+        'path': path,
+        'distance': distance,
+        'error': None if error is None else str(error),
+        'stats': stats,
+    }
+
+
+# Graph used by solve_route_task in pool workers, set once per worker process
+route_graph = None
+
+def set_route_graph(graph):
+    global route_graph
+    route_graph = graph
+    aco.ignore_interrupt()
+
+def solve_route_task(route, options, callback=None, cancel=None, graph=None):
+    source, destination = route
+    if source is None or destination is None:
+        return route_result(source, destination, error='Start or end stop not found in graph')
+
+    if cancel is not None and cancel.is_set():
+        return route_result(source, destination, error='Cancelled')
+
+    if graph is None:
+        graph = route_graph
+
+    stats = {}
+    try:
+        print('\nRoute ' + str(source) + ' to ' + str(destination))
+        start = time.perf_counter()
+        path, distance = solve_route(
+            graph, source, destination, callback=callback, cancel=cancel, stats=stats, **options
+        )
+        stats['solve_seconds'] = time.perf_counter() - start
+    except Exception as error:
+        return route_result(source, destination, error=error, stats=stats)
+
+    if not path:
+        return route_result(source, destination, error='No ant reached the destination', stats=stats)
+
+    return route_result(source, destination, path, distance, stats=stats)
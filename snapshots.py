@@ -0,0 +1,241 @@
+# Versioned, read-only graph snapshots shared by every server worker. A
+# compile step builds a graph once and publishes its CSR arrays (node labels,
+# adjacency, edge weights, populations and coordinates) as .npy files under
+# SNAPSHOT_DIR/<name>/<version>/. Workers memory-map them read-only, so they
+# share one copy through the page cache instead of each building their own,
+# and switch to a newly published version on their next request:
+#
+#   python snapshots.py compile --mode intersections
+#   python snapshots.py list
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import numpy as np
+
+import regions
+from aco_numpy import GraphArrays
+from contraction import EdgeGeometry
+
+
+SNAPSHOT_DIR = os.environ.get('ACO_SNAPSHOT_DIR', os.path.join('data', 'snapshots'))
+
+# Versions kept per snapshot when publishing, older ones are removed. Workers
+# still mapping a removed version keep reading it until they switch
+KEEP_VERSIONS = int(os.environ.get('ACO_SNAPSHOT_KEEP', 2))
+
+FIELDS = ('nodes', 'indptr', 'indices', 'weights', 'edge_ids', 'population', 'coords')
+
+# Street polylines of a contracted road graph, when it has them
+GEOMETRY_FIELDS = ('ends', 'indptr', 'coords')
+
+# File naming the published version of a snapshot
+CURRENT = 'CURRENT'
+
+# name -> (version, arrays) of the snapshots mapped by this process
+mapped = {}
+lock = threading.Lock()
+
+
+# Snapshots are built per mode and graph settings, like the graphs in graphs.py,
+# and per region (see regions.py). Tauranga, the original area, is left out
+# of the name
+def snapshot_name(mode, graph_mode='knn', neighbours=8, radius=None, demand=None, contract=None, region=None):
+    settings = [graph_mode, neighbours, radius] if mode == 'bus_stops' else []
+    contracted = None if contract is None or mode == 'bus_stops' else 'contract' + str(contract)
+    region = None if region == regions.TAURANGA.name else region
+
+    return '_'.join(str(part) for part in [mode] + settings + [demand, contracted, region] if part is not None)
+
+
+def snapshot_path(name, version=None):
+    if version is None:
+        return os.path.join(SNAPSHOT_DIR, name)
+
+    return os.path.join(SNAPSHOT_DIR, name, version)
+
+
+# The arrays a snapshot saves, as (file name, array)
+def snapshot_files(arrays):
+    files = [(field, getattr(arrays, field)) for field in FIELDS]
+
+    geometry = arrays.graph.get('edge_geometry')
+    if geometry is not None:
+        files += [('geometry_' + field, getattr(geometry, field)) for field in GEOMETRY_FIELDS]
+
+    return files
+
+# Hash of every saved array, so any change to the graph, including only its
+# populations or coordinates, makes a new version
+def snapshot_version(files):
+    digest = hashlib.blake2b(digest_size=16)
+    for field, array in files:
+        array = np.ascontiguousarray(array)
+        digest.update(repr((field, array.dtype.str, array.shape)).encode())
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+
+# Write the arrays as a new version and make it the current one. Publishing
+# an unchanged graph reuses its version
+def publish(name, arrays, metadata=None):
+    files = snapshot_files(arrays)
+    version = snapshot_version(files)
+    path = snapshot_path(name, version)
+
+    # Write to a temporary directory first so readers never see a partial
+    # version. Temporary names are unique, as threads share a process id
+    if not os.path.isdir(path):
+        temporary_path = path + '.' + uuid.uuid4().hex + '.tmp'
+        os.makedirs(temporary_path)
+        for field, array in files:
+            np.save(os.path.join(temporary_path, field + '.npy'), np.asarray(array))
+
+        with open(os.path.join(temporary_path, 'metadata.json'), 'w') as file:
+            json.dump(dict(
+                metadata or {},
+                version=version,
+                fingerprint=arrays.fingerprint,
+                created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                nodes=arrays.num_nodes,
+                edges=arrays.num_edges,
+            ), file, indent=2)
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            # Published by someone else in the meantime
+            if not os.path.isdir(path):
+                raise
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+    # Switching the pointer file is atomic, so a version is published whole
+    current_path = os.path.join(snapshot_path(name), CURRENT)
+    temporary_path = current_path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(version)
+    os.replace(temporary_path, current_path)
+    os.utime(path)
+
+    prune(name)
+
+    return version
+
+
+# Remove all but the KEEP_VERSIONS most recently published versions
+def prune(name, keep=None):
+    keep = KEEP_VERSIONS if keep is None else keep
+    current = current_version(name)
+
+    directory = snapshot_path(name)
+    versions = [
+        version for version in os.listdir(directory)
+        if not version.endswith('.tmp') and os.path.isdir(os.path.join(directory, version))
+    ]
+    versions.sort(key=lambda version: os.path.getmtime(os.path.join(directory, version)), reverse=True)
+
+    for version in versions[max(keep, 1):]:
+        if version != current:
+            shutil.rmtree(os.path.join(directory, version), ignore_errors=True)
+
+
+def current_version(name):
+    try:
+        with open(os.path.join(snapshot_path(name), CURRENT)) as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+# Map a version's arrays read-only, without copying them into memory
+def read_snapshot(name, version):
+    path = snapshot_path(name, version)
+    fields = {field: np.load(os.path.join(path, field + '.npy'), mmap_mode='r') for field in FIELDS}
+
+    arrays = GraphArrays(**fields)
+
+    # The graph fingerprint (see GraphArrays.fingerprint) without hashing the
+    # mapped arrays again
+    with open(os.path.join(path, 'metadata.json')) as file:
+        arrays._fingerprint = json.load(file).get('fingerprint')
+
+    if os.path.exists(os.path.join(path, 'geometry_ends.npy')):
+        arrays.graph['edge_geometry'] = EdgeGeometry(**{
+            field: np.load(os.path.join(path, 'geometry_' + field + '.npy'), mmap_mode='r') for field in GEOMETRY_FIELDS
+        })
+
+    return arrays
+
+
+# The current version of a snapshot, None if it has not been published. The
+# mapping is reused until another version is published, requests already
+# holding the old arrays carry on with them
+def load_snapshot(name):
+    version = current_version(name)
+    if version is None:
+        return None
+
+    with lock:
+        cached = mapped.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    try:
+        arrays = read_snapshot(name, version)
+    except FileNotFoundError:
+        # Pruned by a newer publish in the meantime
+        return None if cached is None else cached[1]
+
+    with lock:
+        mapped[name] = (version, arrays)
+
+    return arrays
+
+
+def main():
+    import graphs
+    from plot_nodes import plot_stops
+
+    parser = argparse.ArgumentParser(description='Compile and publish graph snapshots for the server workers')
+    parser.add_argument('command', choices=['compile', 'list'])
+    parser.add_argument('--mode', default='intersections', choices=graphs.MODES)
+    parser.add_argument('--graph', default='knn', help='Stop graph mode for create_graph_with_distances')
+    parser.add_argument('--neighbours', type=int, default=8)
+    parser.add_argument('--radius', type=float)
+    parser.add_argument('--demand', choices=['demand', 'both'])
+    parser.add_argument('--contract', type=float, metavar='METRES', help='Contract the road graph, merging intersections within METRES')
+    parser.add_argument('--region', help='Area as west,south,east,north or a polygon file, Tauranga by default')
+    parser.add_argument('--tile-size', type=float, help='Load the region in tiles of this many degrees')
+    parser.add_argument('--refresh', action='store_true', help='Download the layers again instead of using the local data store')
+    args = parser.parse_args()
+
+    if args.command == 'compile':
+        region = regions.region_option(args.region, args.tile_size)
+        stops = plot_stops(args.refresh, region) if args.mode == 'bus_stops' else None
+        _, arrays = graphs.build_graph(
+            args.mode, stops, 'numpy', args.graph, args.neighbours, args.radius, args.refresh, args.demand,
+            args.contract, region
+        )
+
+        name = snapshot_name(
+            args.mode, args.graph, args.neighbours, args.radius, args.demand, args.contract, region.name
+        )
+        version = publish(name, arrays, {'settings': vars(args)})
+        print('Published ' + name + ' version ' + version)
+
+    elif args.command == 'list':
+        if os.path.isdir(SNAPSHOT_DIR):
+            for name in sorted(os.listdir(SNAPSHOT_DIR)):
+                current = current_version(name)
+                for version in sorted(os.listdir(snapshot_path(name))):
+                    if version != CURRENT and not version.endswith('.tmp'):
+                        print(name + ' ' + version + (' (current)' if version == current else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,72 @@
+// Leaflet map with the bus stops underneath and the routes drawn on top
+var map = null;
+var routeLayer = null;
+
+// Line currently drawn for each route, replaced as better paths arrive
+var routeLines = {};
+
 function newMap() {
+    var container = document.getElementById('map-container');
+    map = L.map(container, {preferCanvas: true}).setView([-37.7, 176.25], 12);
+    L.tileLayer(container.dataset.tiles, {attribution: container.dataset.attribution, maxZoom: 19}).addTo(map);
+    routeLayer = L.layerGroup().addTo(map);
+
+    // The stop layer is built once on the server and revalidated with its ETag
+    getJSON('/stops.geojson', function(stops) {
+        var stopLayer = L.geoJSON(stops, {
+            pointToLayer: function(feature, latlng) {
+                return L.circleMarker(latlng, {radius: 4, color: '#ABABAB', weight: 1, fillOpacity: 0.8});
+            },
+            onEachFeature: function(feature, layer) {
+                layer.bindTooltip('Stop ' + feature.properties.ref + (feature.properties.name ? ', ' + feature.properties.name : ''));
+            }
+        }).addTo(map);
+        map.fitBounds(stopLayer.getBounds());
+    });
+}
+
+function getJSON(url, callback) {
     var xhr = new XMLHttpRequest();
     xhr.onreadystatechange = function() {
         if (xhr.readyState === 4 && xhr.status === 200) {
-            document.getElementById('map-container').innerHTML = xhr.responseText;
+            callback(JSON.parse(xhr.responseText));
         }
     };
-    xhr.open('GET', '/generate_stops', true);
+    xhr.open('GET', url, true);
     xhr.send();
 }
 
+// Draw (or redraw) one route from its [longitude, latitude] coordinates, or
+// the single position of a route that starts and ends at the same node
+function drawRoute(route, coordinates, colour) {
+    if (routeLines[route]) {
+        routeLayer.removeLayer(routeLines[route]);
+    }
+    var geometry = {type: 'LineString', coordinates: coordinates};
+    if (typeof coordinates[0] === 'number') {
+        geometry = {type: 'Point', coordinates: coordinates};
+    } else if (coordinates.length === 1) {
+        geometry = {type: 'Point', coordinates: coordinates[0]};
+    }
+    routeLines[route] = L.geoJSON(geometry, {
+        style: {color: colour, weight: 4},
+        pointToLayer: function(feature, latlng) {
+            return L.circleMarker(latlng, {radius: 6, color: colour});
+        }
+    });
+    routeLayer.addLayer(routeLines[route]);
+}
+
+function routeColour(route) {
+    var colours = document.getElementById('map-container').dataset.colours.split(',');
+    return colours[(route - 1) % colours.length];
+}
+
+function clearRoutes() {
+    routeLayer.clearLayers();
+    routeLines = {};
+}
+
 function updateMap() {
     // Get number of ants and iterations from the settings menu
     var numAnts = document.getElementById('num_ants').value;
@@ -41,19 +99,106 @@ function updateMap() {
         endArray.push(encodeURIComponent(element.value));
     });
 
-    // Create the GET request with arrays of values
+    // Update the request URL to include arrays of values, ants, and iterations
+    var query = 'start_node=' + startArray.join('&start_node=') + '&end_node=' + endArray.join('&end_node=') + '&num_ants=' + numAnts + '&num_iterations=' + numIterations + '&mode=' + mode;
+
+    // Submit the run as a background job and follow its progress
     var xhr = new XMLHttpRequest();
     xhr.onreadystatechange = function() {
-        if (xhr.readyState === 4 && xhr.status === 200) {
-            document.getElementById('map-container').innerHTML = xhr.responseText;
+        if (xhr.readyState !== 4) {
+            return;
+        }
+        if (xhr.status === 202) {
+            followJob(JSON.parse(xhr.responseText).id);
+        } else {
+            setStatus(xhr.status === 503 ? 'The server is busy, try again later' : 'Could not start the run');
         }
     };
 
-    // Update the GET request URL to include arrays of values, ants, and iterations
-    xhr.open('GET', '/generate_routes?start_node=' + startArray.join('&start_node=') + '&end_node=' + endArray.join('&end_node=') + '&num_ants=' + numAnts + '&num_iterations=' + numIterations + '&mode=' + mode, true);
+    clearRoutes();
+    xhr.open('POST', '/jobs?' + query + '&precision=5', true);
     xhr.send();
 }
 
+// Id and event stream of the job currently running
+var currentJob = null;
+var currentEvents = null;
+
+function followJob(jobId) {
+    if (currentEvents) {
+        currentEvents.close();
+    }
+    currentJob = jobId;
+    document.getElementById('cancel_run').style.display = 'block';
+    setStatus('Waiting for a free worker');
+
+    var events = new EventSource('/jobs/' + jobId + '/events');
+    currentEvents = events;
+
+    // Best-so-far distance of a route after each iteration, with its path when it improved
+    events.addEventListener('progress', function(event) {
+        var progress = JSON.parse(event.data);
+        var distance = progress.distance === null ? 'none yet' : progress.distance.toFixed(4);
+        setStatus('Route ' + progress.route + ', iteration ' + progress.iteration + ', best distance ' + distance);
+
+        if (progress.path && progress.path.length > 1) {
+            drawRoute(progress.route, progress.path, routeColour(progress.route));
+        }
+    });
+
+    events.addEventListener('status', function(event) {
+        var job = JSON.parse(event.data);
+        if (job.status === 'running') {
+            setStatus('Running');
+        } else if (job.status === 'done' || job.status === 'cancelled') {
+            events.close();
+            finishJob(job);
+        } else if (job.status === 'failed') {
+            events.close();
+            setStatus('Run failed: ' + job.error);
+            document.getElementById('cancel_run').style.display = 'none';
+        }
+    });
+}
+
+function finishJob(job) {
+    document.getElementById('cancel_run').style.display = 'none';
+    setStatus(job.status === 'cancelled' ? 'Cancelled, showing best routes so far' : 'Done');
+
+    // Replace the intermediate lines with the final routes
+    getJSON('/jobs/' + job.id + '/result?format=geojson&precision=5', function(routes) {
+        clearRoutes();
+
+        var errors = [];
+        routes.features.forEach(function(feature) {
+            var route = feature.properties;
+            if (feature.geometry === null) {
+                errors.push('route ' + route.route + ': ' + route.error);
+                return;
+            }
+            drawRoute(route.route, feature.geometry.coordinates, route.colour);
+            routeLines[route.route].bindPopup('Route ' + route.route + ', ' + route.source + ' to ' + route.destination + ', distance ' + route.distance.toFixed(4));
+        });
+
+        if (errors.length > 0) {
+            setStatus('Failed ' + errors.join(', '));
+        }
+    });
+}
+
+function cancelRun() {
+    if (currentJob) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('POST', '/jobs/' + currentJob + '/cancel', true);
+        xhr.send();
+        setStatus('Cancelling');
+    }
+}
+
+function setStatus(text) {
+    document.getElementById('run_status').textContent = text;
+}
+
 function addBusStop() {
     // Clone the bus stop template and increment the ID
     var busStopTemplate = document.querySelector('.bus_stop');